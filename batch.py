@@ -0,0 +1,182 @@
+"""
+Headless batch runner for the PRN Extractor tools.
+
+Processes every .xlsx workbook in a directory with the same ingest, match
+and insert code the Streamlit pages use, one workbook per worker process.
+hod needs a directory holding one list, since each list replaces the
+table's eligibility, and dropout workbooks run one at a time because they
+update the same table. Run it from the app directory so
+.streamlit/secrets.toml is found, e.g.
+
+    python batch.py prn uploads/fe --class FE --columns "Name,PRN,Date" --year-of-enrollment
+    python batch.py dropout uploads/dropouts --table 1_comps_se --db-column Name --excel-column Name
+    python batch.py hod uploads/hod --table 1_comps_se --db-column Name --excel-column Name
+    python batch.py match uploads/fe --table all_fe_2023_24 --db-column Name --excel-column Name --target-table 1_comps_FE
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from io import BytesIO
+from pathlib import Path
+
+
+def load_sheet(path, sheet, dtype=None):
+    from ingest import read_sheet
+    return read_sheet(BytesIO(Path(path).read_bytes()), "batch", sheet, dtype)
+
+
+def run_prn(path, options):
+    import pg1
+    dept_name, class_name = options["department"], options["class_name"]
+    if class_name == "FE":
+        dept_name = "All"
+    elif dept_name == "All" and class_name != "DSE":
+        class_name = "FE"
+
+    with_department = dept_name == "All" and class_name == "DSE"
+    df = load_sheet(path, options["sheet"], dtype=str)
+    final_df = pg1.prepare_records(
+        df, options["columns"], options["year_of_enrollment"], with_department)
+    table_name = pg1.resolve_table_name(dept_name, class_name, pg1.fetch_departments())
+    inserted = pg1.save_records(final_df, table_name, with_department)
+    return f"{inserted} new rows saved to {table_name}"
+
+
+def run_dropout(path, options):
+    import pg3
+    df = load_sheet(path, options["sheet"])
+    connection = pg3.get_connection()
+    try:
+        matched, _, unmatched = pg3.mark_dropouts(
+            connection, options["table"], options["db_column"], df[options["excel_column"]])
+    finally:
+        connection.close()
+    return f"{len(matched)} marked not eligible, {len(unmatched)} unmatched"
+
+
+def run_hod(path, options):
+    import pg3
+    df = load_sheet(path, options["sheet"])
+    connection = pg3.get_connection()
+    try:
+        matched, unmatched, changes = pg3.apply_hod_list(
+            connection, options["table"], options["db_column"], df[options["excel_column"]])
+    finally:
+        connection.close()
+    return f"{len(matched)} eligible, {len(unmatched)} not eligible, {len(changes)} changed"
+
+
+def run_match(path, options):
+    import pg4
+    df = load_sheet(path, options["sheet"])
+    conn = pg4.get_connection()
+    try:
+        db_data = pg4.get_table_data(conn, options["table"])
+        matched_df, unmatched = pg4.match_records(
+            df[options["excel_column"]].dropna().tolist(), db_data, options["db_column"],
+            options["table"])
+        inserted = pg4.insert_matched_records(conn, options["target_table"], matched_df, options["db_column"])
+    finally:
+        conn.close()
+    return (f"{len(matched_df)} matched, {inserted} new rows saved to {options['target_table']}, "
+            f"{len(unmatched)} unmatched")
+
+
+def prepare_match_target(options):
+    """Create the target table and its key once, before the workers insert into it."""
+    import pg4
+    conn = pg4.get_connection()
+    try:
+        pg4.create_table_like(conn, options["target_table"], options["table"])
+        pg4.ensure_unique_key(conn.cursor(), options["target_table"], options["db_column"])
+    finally:
+        conn.close()
+
+
+COMMANDS = {
+    "prn": run_prn,
+    "dropout": run_dropout,
+    "hod": run_hod,
+    "match": run_match,
+}
+
+
+def process_file(command, path, options):
+    return COMMANDS[command](path, options)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_command(name, help_text):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument("directory", type=Path, help="Directory of .xlsx workbooks")
+        sub.add_argument("--sheet", default=0, help="Sheet name to read (default: first sheet)")
+        sub.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes")
+        return sub
+
+    prn = add_command("prn", "Save workbooks to the database like the PRN Generator")
+    prn.add_argument("--department", default="All", help="Department name, or All")
+    prn.add_argument("--class", dest="class_name", default="FE", choices=["FE", "SE", "TE", "BE", "DSE"])
+    prn.add_argument("--columns", required=True,
+                     help="Comma-separated Excel columns in Name, Enrollment Number, Date order")
+    prn.add_argument("--year-of-enrollment", action="store_true", help="Add the Year of Enrollment column")
+
+    for name, help_text in (("dropout", "Mark dropout students not eligible"),
+                            ("hod", "Apply HOD lists to eligibility"),
+                            ("match", "Copy matched students into a new table")):
+        sub = add_command(name, help_text)
+        sub.add_argument("--table", required=True, help="Database table to match against")
+        sub.add_argument("--db-column", required=True)
+        sub.add_argument("--excel-column", required=True)
+        if name == "match":
+            sub.add_argument("--target-table", required=True, help="Table receiving matched rows")
+
+    args = parser.parse_args(argv)
+    if args.command == "prn":
+        args.columns = [column.strip() for column in args.columns.split(",")]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = {key: value for key, value in vars(args).items()
+               if key not in ("command", "directory", "workers")}
+    paths = sorted(args.directory.glob("*.xlsx"))
+    if not paths:
+        print(f"No .xlsx files found in {args.directory}")
+        return 1
+
+    workers = args.workers
+    if args.command == "hod":
+        # Every HOD list marks the rows it does not name not eligible, so lists for one table overwrite each other
+        if len(paths) > 1:
+            print(f"hod applies one list per table; {args.directory} holds {len(paths)} workbooks",
+                  file=sys.stderr)
+            return 1
+    elif args.command == "dropout":
+        # Concurrent joined UPDATEs on one table can deadlock, so mark one workbook at a time
+        workers = 1
+    elif args.command == "match":
+        prepare_match_target(options)
+
+    failures = 0
+    # Spawned workers open their own connection pools instead of inheriting the parent's sockets
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {executor.submit(process_file, args.command, path, options): path for path in paths}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                print(f"{path.name}: {future.result()}")
+            except Exception as e:
+                failures += 1
+                print(f"{path.name}: failed: {e}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
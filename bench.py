@@ -0,0 +1,369 @@
+"""
+Benchmarks for the PRN Extractor hot paths on synthetic student rosters.
+
+Every benchmark runs the page code itself against an in-memory stand-in for
+the MySQL pool, so the numbers cover local work plus an optional simulated
+round trip per statement and commit. Run it from the app directory so the
+pages can import with .streamlit/secrets.toml (no server is contacted), e.g.
+
+    python bench.py
+    python bench.py --sizes 1000 10000 --only match export --latency-ms 0.5
+    python bench.py --json /tmp/bench-$(git rev-parse --short HEAD).json
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_SIZES = [1000, 10000, 100000, 500000]
+
+# Excel values matched against the roster by the matching benchmarks
+DEFAULT_QUERIES = 1000
+
+# Names on an HOD list; the extractOne loop scores every roster row against each of them
+HOD_LIST_SIZE = 200
+
+FIRST_NAMES = [
+    "Aarav", "Aditya", "Akash", "Ananya", "Anjali", "Arjun", "Ayesha", "Deepak", "Divya", "Gaurav",
+    "Isha", "Karan", "Kavya", "Manish", "Meera", "Neha", "Nikhil", "Omkar", "Pooja", "Pranav",
+    "Priya", "Rahul", "Riya", "Rohan", "Sagar", "Sakshi", "Sanjay", "Shreya", "Siddharth", "Sneha",
+    "Suresh", "Tanvi", "Tejas", "Varun", "Vedant", "Vikram", "Yash", "Zoya", "Harsh", "Mrunal",
+]
+SURNAMES = [
+    "Agarwal", "Bhosale", "Chavan", "Deshmukh", "Deshpande", "Gaikwad", "Ghosh", "Gupta", "Iyer", "Jadhav",
+    "Joshi", "Kadam", "Kale", "Kulkarni", "Kumar", "Mehta", "Menon", "Mishra", "More", "Nair",
+    "Naik", "Patel", "Patil", "Pawar", "Rao", "Reddy", "Sawant", "Shah", "Sharma", "Shinde",
+    "Shirke", "Singh", "Thakur", "Trivedi", "Verma", "Wagh", "Yadav", "Pillai", "Bose", "Sane",
+]
+DEPARTMENTS = [(1, "comps"), (2, "it"), (3, "extc"), (4, "mech"), (5, "ecs"), (6, "auto")]
+
+
+def make_roster(size, seed=0):
+    """Build a class table of `size` students with unique names and enrollment numbers."""
+    rng = np.random.default_rng(seed)
+    surnames = rng.choice(SURNAMES, size)
+    first = rng.choice(FIRST_NAMES, size)
+    middle = rng.choice(FIRST_NAMES, size)
+    serial = np.arange(size)
+    # Serial suffix keeps names unique the way a real roster's full names are
+    names = [f"{s} {f} {m} {i:06d}" for s, f, m, i in zip(surnames, first, middle, serial)]
+    dept_index = rng.integers(0, len(DEPARTMENTS), size)
+    dates = pd.Timestamp("2023-06-01") + pd.to_timedelta(rng.integers(0, 120, size), unit="D")
+    return pd.DataFrame({
+        "Name": names,
+        "Year of Enrollment": "2023-24",
+        "Student's Enrollment Number": [f"2023{DEPARTMENTS[d][0]:02d}{i:07d}" for d, i in zip(dept_index, serial)],
+        "Eligibility": "eligible",
+        "Date of Enrollment": dates.strftime("%Y-%m-%d"),
+        "Department": [DEPARTMENTS[d][1] for d in dept_index],
+    })
+
+
+def make_queries(roster, count, seed=0):
+    """Pick roster names as an uploaded list would spell them: recased, reordered and with typos."""
+    rng = np.random.default_rng(seed + 1)
+    names = roster["Name"].to_numpy()[rng.integers(0, len(roster), count)]
+    queries = []
+    for name, style in zip(names, rng.integers(0, 4, count)):
+        words = name.split()
+        if style == 0:
+            queries.append(name.upper())
+        elif style == 1:
+            queries.append(" ".join([words[1], words[0]] + words[2:]))
+        elif style == 2:
+            queries.append(name[:3] + name[4:])
+        else:
+            queries.append(f"Unknown Student {rng.integers(10 ** 6):06d}")
+    return queries
+
+
+class StandInDatabase:
+    """In-memory stand-in for the pool: serves SELECT * from registered tables and counts writes."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tables = {}
+        self.statements = 0
+        self.commits = 0
+        self.rows_written = 0
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def connect(self):
+        return StandInConnection(self)
+
+
+class StandInConnection:
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self, buffered=None):
+        return StandInCursor(self.db)
+
+    def commit(self):
+        self.db.commits += 1
+        self.db.round_trip()
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def invalidate(self):
+        pass
+
+    def is_connected(self):
+        return True
+
+
+class StandInCursor:
+    SELECT_ALL = re.compile(r"^\s*SELECT \* FROM `?(\w+)`?\s*$", re.IGNORECASE)
+    COUNT = re.compile(r"SELECT '(\w+)', COUNT\(\*\) FROM")
+
+    def __init__(self, db):
+        self.db = db
+        self.rowcount = -1
+        self.description = None
+        self.column_names = ()
+        self._rows = []
+
+    def execute(self, query, params=None):
+        self.db.statements += 1
+        self.db.round_trip()
+        self._rows = []
+        self.description = None
+        self.column_names = ()
+        self.rowcount = 0
+        select = self.SELECT_ALL.match(query)
+        if select and select.group(1) in self.db.tables:
+            df = self.db.tables[select.group(1)]
+            self.column_names = tuple(df.columns)
+            self.description = [(column, None, None, None, None, None, True) for column in df.columns]
+            self._rows = list(df.itertuples(index=False, name=None))
+            self.rowcount = len(self._rows)
+        elif self.COUNT.search(query):
+            self._rows = [(table, len(self.db.tables.get(table, ()))) for table in self.COUNT.findall(query)]
+        elif query.startswith("CHECKSUM TABLE"):
+            # No checksum, so table signatures never match and every run reads the table
+            self._rows = [(f"bench.{table}", None) for table in re.findall(r"`(\w+)`", query)]
+        elif query.startswith("SHOW COUNT(*) WARNINGS"):
+            self._rows = [(0,)]
+        elif query.lstrip().upper().startswith("INSERT"):
+            self.db.rows_written += 1
+            self.rowcount = 1
+
+    def executemany(self, query, seq_params):
+        rows = list(seq_params)
+        self.db.statements += 1
+        self.db.round_trip()
+        self.db.rows_written += len(rows)
+        self.rowcount = len(rows)
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchmany(self, size=1):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def close(self):
+        pass
+
+
+@contextmanager
+def stand_in(db, *modules):
+    """Point get_connection in db.py and the given page modules at the stand-in."""
+    import db as db_module
+    targets = [db_module, *modules]
+    originals = [target.get_connection for target in targets]
+    for target in targets:
+        target.get_connection = db.connect
+    try:
+        yield db
+    finally:
+        for target, original in zip(targets, originals):
+            target.get_connection = original
+
+
+def bench_match(roster, queries, db):
+    import pg4
+    pg4.match_records(queries, roster, "Name")
+
+
+def bench_matched_save(roster, queries, db):
+    import pg4
+    with stand_in(db, pg4):
+        pg4.insert_matched_records(db.connect(), "1_comps_FE", roster, "Name")
+
+
+def bench_dropout(roster, queries, db):
+    import memo
+    import pg3
+    db.tables["bench_roster"] = roster
+    # A fresh memo file so every run scores from scratch
+    with tempfile.TemporaryDirectory() as memo_dir, stand_in(db):
+        original_path, memo.MEMO_PATH = memo.MEMO_PATH, os.path.join(memo_dir, "memo.sqlite3")
+        try:
+            pg3.mark_dropouts(db.connect(), "bench_roster", "Name", pd.Series(queries))
+        finally:
+            memo.MEMO_PATH = original_path
+
+
+def bench_hod(roster, queries, db):
+    import pg3
+    db.tables["bench_roster"] = roster
+    with stand_in(db):
+        pg3.apply_hod_list(db.connect(), "bench_roster", "Name", pd.Series(queries[:HOD_LIST_SIZE]))
+
+
+def bench_prn(roster, queries, db):
+    import pg1
+    upload = roster[["Name", "Student's Enrollment Number", "Date of Enrollment"]].copy()
+    with stand_in(db, pg1):
+        final_df = pg1.prepare_records(upload, list(upload.columns), add_year_of_enrollment=True)
+        pg1.save_records(final_df, "all_fe_2023_24")
+
+
+def bench_export(roster, queries, db):
+    import pg2
+    pg2.build_excel({"Sheet1": roster})
+
+
+def bench_dse(roster, queries, db):
+    import pg5
+    table_names = pg5.dse_table_names(pd.DataFrame(DEPARTMENTS, columns=["Dept_no", "Dept_Code"]))
+    with stand_in(db, pg5), ThreadPoolExecutor(max_workers=pg5.POOL_SIZE) as executor:
+        pg5.distribute_chunk(executor, roster, table_names, {}, {})
+
+
+# name -> (function, description, largest roster it runs on by default)
+BENCHMARKS = {
+    "match": (bench_match, "pg4 match_records", None),
+    "save": (bench_matched_save, "pg4 insert_matched_records", None),
+    "dropout": (bench_dropout, "pg3 dropout matching and update", None),
+    "hod": (bench_hod, "pg3 HOD extractOne loop and update", 1000),
+    "prn": (bench_prn, "pg1 prepare and save records", None),
+    "export": (bench_export, "pg2 build_excel", None),
+    "dse": (bench_dse, "pg5 DSE distribution", None),
+}
+
+
+def run_benchmark(name, roster, queries, latency, repeat):
+    func = BENCHMARKS[name][0]
+    timings = []
+    for _ in range(repeat):
+        db = StandInDatabase(latency)
+        start = time.perf_counter()
+        func(roster, queries, db)
+        timings.append(time.perf_counter() - start)
+
+    # Measured in a separate run; tracing Python allocations slows the timed code
+    traced = StandInDatabase(0.0)
+    tracemalloc.start()
+    try:
+        func(roster, queries, traced)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    seconds = min(timings)
+    return {
+        "benchmark": name,
+        "rows": len(roster),
+        "queries": len(queries),
+        "seconds": round(seconds, 4),
+        "rows_per_second": round(len(roster) / seconds) if seconds else None,
+        "peak_mib": round(peak / 2 ** 20, 2),
+        "statements": db.statements,
+        "commits": db.commits,
+        "rows_written": db.rows_written,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Roster sizes in rows")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                        help="Benchmarks to run (default: all)")
+    parser.add_argument("--queries", type=int, default=DEFAULT_QUERIES,
+                        help="Uploaded names matched against each roster")
+    parser.add_argument("--repeat", type=int, default=1, help="Timed runs per case; the fastest is reported")
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="Simulated round trip per statement and commit")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--full", action="store_true", help="Also run benchmarks above their default size limit")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Import every page up front so import time is not charged to the first benchmark
+    import pg1, pg2, pg3, pg4, pg5  # noqa: E401,F401
+    import tracing
+    tracing.TRACE_LOG_PATH = os.devnull
+    # The pages run outside `streamlit run`; silence the bare-mode warnings
+    from streamlit.logger import set_log_level
+    set_log_level("error")
+    warnings.filterwarnings("ignore", message="pandas only supports SQLAlchemy")
+    warnings.filterwarnings("ignore", category=pd.errors.SettingWithCopyWarning)
+
+    results = []
+    print(f"{'benchmark':<10}{'rows':>9}{'seconds':>10}{'rows/s':>12}{'peak MiB':>10}"
+          f"{'stmts':>8}{'commits':>9}")
+    for size in args.sizes:
+        roster = make_roster(size, args.seed)
+        queries = make_queries(roster, args.queries, args.seed)
+        for name in args.only:
+            limit = BENCHMARKS[name][2]
+            if limit is not None and size > limit and not args.full:
+                print(f"{name:<10}{size:>9}  skipped (over {limit} rows, use --full)")
+                continue
+            result = run_benchmark(name, roster, queries, args.latency_ms / 1000, args.repeat)
+            results.append(result)
+            print(f"{name:<10}{size:>9}{result['seconds']:>10.3f}{result['rows_per_second'] or 0:>12,}"
+                  f"{result['peak_mib']:>10.1f}{result['statements']:>8}{result['commits']:>9}")
+
+    if args.json_path:
+        report = {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "latency_ms": args.latency_ms,
+            "seed": args.seed,
+            "results": results,
+        }
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+import streamlit as st
+from rapidfuzz import utils
+from streamlit import runtime
+
+from db import read_query, table_signatures
+from matching import NgramIndex, choice_forms
+from memo import column_fingerprint
+
+# Honorifics dropped from names before exact lookups
+TITLES = {"mr", "mrs", "ms", "miss", "dr", "prof", "shri", "sri", "smt", "kum", "km"}
+
+# Tables whose rows and indexes a session keeps; the least recently loaded is dropped first
+SESSION_TABLES = 4
+
+
+def normalize_name(value):
+    """Lowercase, drop punctuation and titles, collapse whitespace and sort the words."""
+    words = utils.default_process(str(value)).split()
+    return " ".join(sorted(word for word in words if word not in TITLES))
+
+
+class CandidateIndex:
+    """
+    Normalized forms of one table column, built once and shared by the matchers.
+
+    Every form is a list aligned with the table's rows, so a match position
+    recovers its record with table_df.iloc[position].
+    """
+
+    def __init__(self, table_df, column):
+        self.table_df = table_df
+        self.column = column
+        self.values = table_df[column].tolist()
+        # Lowercased and token-sorted forms scored by matching.best_matches
+        self.forms = choice_forms(self.values)
+        self.positions = {}
+        for position, value in enumerate(self.values):
+            if value is not None and value == value:  # Skip NULL and NaN
+                self.positions.setdefault(normalize_name(value), position)
+        self._fingerprint = None
+        self._ngram_index = None
+
+    def find(self, value):
+        """Position of the first row whose normalized name equals the value's, or None."""
+        return self.positions.get(normalize_name(value))
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = column_fingerprint(self.values)
+        return self._fingerprint
+
+    @property
+    def ngram_index(self):
+        if self._ngram_index is None:
+            self._ngram_index = NgramIndex(self.values)
+        return self._ngram_index
+
+
+def candidate_index(table_name, column, connection=None):
+    """
+    Return the session's CandidateIndex for a table column.
+
+    The table's rows are read once per session and reused while its row
+    count and checksum stay the same, so later matches skip the SELECT *.
+    Checking them still scans the table, so call this when a match runs,
+    not on every rerun. Outside a Streamlit session, e.g. in batch.py, a
+    fresh index is built every call.
+    """
+    signature = table_signatures([table_name])[table_name]
+    tables = st.session_state.setdefault("candidate_indexes", {}) if runtime.exists() else {}
+    entry = tables.get(table_name)
+    # A NULL checksum cannot prove the table unchanged
+    if entry is None or entry["signature"] != signature or signature[1] is None:
+        tables.pop(table_name, None)
+        # Taken before the read, so a concurrent write only causes a reload next time
+        entry = {"signature": signature, "indexes": {},
+                 "table_df": read_query(f"SELECT * FROM `{table_name}`", connection=connection)}
+        tables[table_name] = entry
+        while len(tables) > SESSION_TABLES:
+            tables.pop(next(iter(tables)))
+
+    if column not in entry["indexes"]:
+        entry["indexes"][column] = CandidateIndex(entry["table_df"], column)
+    return entry["indexes"][column]
@@ -0,0 +1,193 @@
+import pandas as pd
+import streamlit as st
+import mysql.connector
+from sqlalchemy import create_engine
+from sqlalchemy.engine import URL
+
+# Load database credentials from secrets.toml
+DB_HOST = st.secrets["database"]["DATABASE_HOST"]
+DB_USER = st.secrets["database"]["DATABASE_USER"]
+DB_PASSWORD = st.secrets["database"]["DATABASE_PASSWORD"]
+DB_NAME = st.secrets["database"]["DATABASE_NAME"]
+DB_PORT = int(st.secrets["database"]["DATABASE_PORT"])
+
+# Pool sizing, overridable from the same secrets section
+POOL_SIZE = int(st.secrets["database"].get("POOL_SIZE", 5))
+POOL_MAX_OVERFLOW = int(st.secrets["database"].get("POOL_MAX_OVERFLOW", 10))
+POOL_RECYCLE_SECONDS = int(st.secrets["database"].get("POOL_RECYCLE_SECONDS", 3600))
+
+# Rows sent per executemany call when inserting a DataFrame
+INSERT_BATCH_SIZE = int(st.secrets["database"].get("INSERT_BATCH_SIZE", 5000))
+
+# Rows per DataFrame chunk when streaming a query
+STREAM_CHUNK_ROWS = 10000
+
+# MySQL error code of a duplicate key, reported as a warning under INSERT IGNORE
+DUPLICATE_ENTRY = 1062
+
+# Schema and lookup queries are served from memory for this long
+METADATA_TTL_SECONDS = int(st.secrets["database"].get("METADATA_TTL_SECONDS", 600))
+
+
+@st.cache_resource
+def get_engine():
+    """Create the SQLAlchemy engine whose pool is shared by every page, rerun and session."""
+    url = URL.create(
+        "mysql+mysqlconnector",
+        username=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port=DB_PORT,
+        database=DB_NAME,
+    )
+    return create_engine(
+        url,
+        pool_size=POOL_SIZE,
+        max_overflow=POOL_MAX_OVERFLOW,
+        pool_recycle=POOL_RECYCLE_SECONDS,
+        pool_pre_ping=True,  # Replace connections the server dropped while idle
+    )
+
+
+def get_connection():
+    """Borrow a MySQL connection from the shared pool; close() hands it back."""
+    return get_engine().raw_connection()
+
+
+def stream_query(query, chunksize=STREAM_CHUNK_ROWS, connection=None):
+    """
+    Yield DataFrames of at most `chunksize` rows from an unbuffered cursor.
+
+    Rows stay on the server until fetched, so memory is bounded by one chunk.
+    At least one (possibly empty) chunk is yielded so callers always see the
+    columns. Uses `connection` if given, otherwise a pooled one.
+    """
+    conn = connection or get_connection()
+    exhausted = False
+    try:
+        cursor = conn.cursor(buffered=False)
+        cursor.execute(query)
+        columns = cursor.column_names
+        rows = cursor.fetchmany(chunksize)
+        yield pd.DataFrame(rows, columns=columns)
+        while rows:
+            rows = cursor.fetchmany(chunksize)
+            if rows:
+                yield pd.DataFrame(rows, columns=columns)
+        exhausted = True
+        cursor.close()
+    finally:
+        if connection is None:
+            if exhausted:
+                conn.close()
+            else:
+                # Unread rows would break the pool's reset; drop the connection instead
+                conn.invalidate()
+
+
+def read_query(query, connection=None):
+    """Read a whole result set into one DataFrame through stream_query."""
+    return pd.concat(stream_query(query, connection=connection), ignore_index=True)
+
+
+
+def table_signatures(tables):
+    """
+    Return {table: [row count, checksum]}, used to tell whether a table changed.
+
+    COUNT(*) and CHECKSUM TABLE both read every row on InnoDB, so only call
+    this when the table's rows are about to be used.
+    """
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(" UNION ALL ".join(f"SELECT '{table}', COUNT(*) FROM `{table}`" for table in tables))
+        counts = dict(cursor.fetchall())
+        # Rows come back in the order the tables are listed
+        cursor.execute("CHECKSUM TABLE " + ", ".join(f"`{table}`" for table in tables))
+        checksums = [row[1] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+    return {table: [counts[table], checksum] for table, checksum in zip(tables, checksums)}
+
+
+def ensure_unique_key(cursor, table_name, column_name):
+    """
+    Make sure column_name has a single-column unique index and no other
+    unique index exists, so INSERT IGNORE only skips rows repeating it.
+
+    Returns False when the table has another unique key (including its
+    primary key), or when the index cannot be added, e.g. because the table
+    already holds duplicates or the column type cannot be indexed. Callers
+    then filter existing rows themselves.
+    """
+    cursor.execute(f"SHOW INDEX FROM `{table_name}`")
+    index_columns = {}
+    for row in cursor.fetchall():
+        non_unique, key_name, column = row[1], row[2], row[4]
+        if not non_unique:
+            index_columns.setdefault(key_name, []).append(column)
+    if [column_name] in index_columns.values():
+        return len(index_columns) == 1
+    if index_columns:
+        return False
+    try:
+        cursor.execute(f"ALTER TABLE `{table_name}` ADD UNIQUE KEY (`{column_name}`)")
+    except mysql.connector.Error:
+        return False
+    return True
+
+
+def check_ignored_warnings(cursor, table_name, skipped):
+    """
+    Raise if an INSERT IGNORE left more warnings than the `skipped` duplicate rows.
+
+    IGNORE also turns truncation and NOT NULL errors into warnings and stores
+    the altered row, so those must still fail the insert.
+    """
+    cursor.execute("SHOW COUNT(*) WARNINGS")
+    if cursor.fetchone()[0] > skipped:
+        cursor.execute("SHOW WARNINGS")
+        messages = [message for _, code, message in cursor.fetchall() if code != DUPLICATE_ENTRY]
+        raise mysql.connector.errors.DataError(
+            f"Insert into {table_name} was not clean: {messages[0] if messages else 'see SHOW WARNINGS'}")
+
+
+def insert_rows(cursor, table_name, df, ignore_duplicates=False, batch_size=INSERT_BATCH_SIZE):
+    """
+    Insert a DataFrame in batched multi-row INSERT statements.
+
+    With ignore_duplicates, rows colliding with a unique key are skipped by
+    the server (INSERT IGNORE); any other warning raises DataError, leaving
+    the caller to roll back. Returns the number of rows inserted.
+    """
+    columns = ", ".join(f"`{col}`" for col in df.columns)
+    placeholders = ", ".join(["%s"] * len(df.columns))
+    ignore = "IGNORE " if ignore_duplicates else ""
+    insert_query = f"INSERT {ignore}INTO `{table_name}` ({columns}) VALUES ({placeholders})"
+    values = df.astype(object).where(df.notna(), None).values.tolist()
+    inserted = 0
+    for start in range(0, len(values), batch_size):
+        batch = values[start:start + batch_size]
+        cursor.executemany(insert_query, batch)
+        batch_inserted = max(cursor.rowcount, 0)
+        if ignore_duplicates:
+            check_ignored_warnings(cursor, table_name, len(batch) - batch_inserted)
+        inserted += batch_inserted
+    return inserted
+
+
+_metadata_functions = []
+
+
+def cache_metadata(func):
+    """Cache a department/table/column lookup; cleared early by clear_metadata_cache()."""
+    cached = st.cache_data(ttl=METADATA_TTL_SECONDS, show_spinner=False)(func)
+    _metadata_functions.append(cached)
+    return cached
+
+
+def clear_metadata_cache():
+    """Drop every cached lookup, e.g. after a CREATE TABLE."""
+    for cached in _metadata_functions:
+        cached.clear()
@@ -0,0 +1,43 @@
+import hashlib
+from io import BytesIO
+
+import pandas as pd
+import streamlit as st
+
+from tracing import span
+
+# Rust-based reader; several times faster than openpyxl on large sheets
+EXCEL_ENGINE = "calamine"
+
+# Parsed sheets kept in memory; least recently used entries are evicted first
+EXCEL_CACHE_ENTRIES = 16
+
+
+def file_digest(uploaded_file):
+    """Hash an upload's content so identical files share cache entries."""
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+
+@st.cache_data(max_entries=EXCEL_CACHE_ENTRIES, show_spinner=False)
+def _sheet_names(digest, _content):
+    return pd.ExcelFile(BytesIO(_content), engine=EXCEL_ENGINE).sheet_names
+
+
+@st.cache_data(max_entries=EXCEL_CACHE_ENTRIES, show_spinner=False)
+def _read_sheet(digest, sheet_name, dtype, _content, _page, _file_name):
+    # Traced here so cache hits on reruns are not logged as parses
+    with span(_page, "upload parse", file=_file_name) as record:
+        df = pd.read_excel(BytesIO(_content), sheet_name=sheet_name, dtype=dtype, engine=EXCEL_ENGINE)
+        record["rows"] = len(df)
+    return df
+
+
+def sheet_names(uploaded_file):
+    """List the sheets of an uploaded workbook, parsing it at most once per content."""
+    return _sheet_names(file_digest(uploaded_file), uploaded_file.getvalue())
+
+
+def read_sheet(uploaded_file, page, sheet_name=0, dtype=None):
+    """Read one sheet of an uploaded workbook, cached by content hash and sheet name."""
+    return _read_sheet(file_digest(uploaded_file), sheet_name, dtype, uploaded_file.getvalue(),
+                       page, getattr(uploaded_file, "name", None))
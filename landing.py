@@ -6,6 +6,7 @@ import pg2
 import pg3
 import pg4
 import pg5
+import tracing
 
 # Set the page configuration
 st.set_page_config(
@@ -51,32 +52,25 @@ st.markdown("""
 st.title("PRN Extractor")
 st.write("Select a tab below.")
 
-tab_labels = [
-    "🏠",
-    "⚡️",
-    "⚖️",
-    "⬇️",
-    "🥈",
-    "📄"
-]
+# Only the selected tool's main() runs on a rerun; the other pages stay dormant
+pages = {
+    "🏠": None,
+    "⚡️": pg1.main,
+    "⚖️": pg3.main,
+    "⬇️": pg4.main,
+    "🥈": pg5.main,
+    "📄": pg2.main,
+}
 
 # Tab interface with symbols
-tabs = st.tabs(tab_labels)
+selected_tab = st.radio(
+    "Select a tab", list(pages), horizontal=True, label_visibility="collapsed")
 
-with tabs[0]:
+if pages[selected_tab] is None:
     st.write("This is the home tab. Select another tab to run a script.")
+else:
+    pages[selected_tab]()
 
-with tabs[1]:
-    pg1.main()
-
-with tabs[5]:
-    pg2.main()
-
-with tabs[2]:
-    pg3.main()
-
-with tabs[3]:
-    pg4.main()
-
-with tabs[4]:
-    pg5.main()
+# Rendered last so it includes the stages of this run
+if st.sidebar.checkbox("Show stage timings"):
+    tracing.show_panel()
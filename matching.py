@@ -0,0 +1,159 @@
+from bisect import bisect_right
+from collections import Counter, defaultdict
+
+import numpy as np
+from rapidfuzz import fuzz, process, utils
+
+# Score-matrix cells per cdist call (float32, so 64 MiB); values per call shrink as the DB column grows
+CDIST_CELLS = 16 * 2 ** 20
+
+# Candidates scored per lookup in an NgramIndex
+MAX_CANDIDATES = 50
+
+# Posting-list entries an NgramIndex lookup counts at most, so lookups stay bounded as tables grow
+MAX_SCANNED_POSTINGS = 10000
+
+
+def first_containing(choices, words):
+    """Map each word to the position of the first choice containing it."""
+    # Choices are joined with a newline; a word from str.split() never contains
+    # whitespace, so it can only ever be found inside a single choice.
+    haystack = "\n".join(choices)
+    offsets = []
+    position = 0
+    for choice in choices:
+        offsets.append(position)
+        position += len(choice) + 1
+
+    positions = {}
+    for word in words:
+        found = haystack.find(word)
+        if found != -1:
+            positions[word] = bisect_right(offsets, found) - 1
+    return positions
+
+
+# fuzzywuzzy's force_ascii drops code points 128-255 (but not higher ones) before processing
+_LATIN1 = dict.fromkeys(range(128, 256))
+
+
+def full_process(text):
+    """fuzzywuzzy's full_process(force_ascii=True): Latin-1 letters dropped, then default_process."""
+    return utils.default_process(str(text).translate(_LATIN1))
+
+
+def token_sort_key(text):
+    """The form token_sort_ratio compares: processed, with the words sorted."""
+    return " ".join(sorted(full_process(text).split()))
+
+
+def choice_forms(choices):
+    """Lowercased and token-sorted forms of the choices, as best_matches uses them."""
+    lowered = [str(choice).lower() for choice in choices]
+    return lowered, [token_sort_key(choice) for choice in lowered]
+
+
+def best_matches(values, choices, threshold=70, workers=-1, forms=None):
+    """
+    Find the best matching choice for every value in one batched pass.
+
+    Scores are token_sort_ratio on lowercased strings, and a choice that
+    contains any word of the value scores 100. The first choice with the
+    highest score wins. Returns (position, score) pairs, where position is
+    None when the best score is below `threshold`. `forms` may carry
+    precomputed choice_forms(choices).
+    """
+    value_strs = [str(value).lower() for value in values]
+    choice_strs, choice_keys = forms or choice_forms(choices)
+    if not value_strs:
+        return []
+    if not choice_strs:
+        return [(None, 0)] * len(value_strs)
+
+    words = {word for value_str in value_strs for word in value_str.split()}
+    word_positions = first_containing(choice_strs, words)
+
+    chunk_size = max(1, CDIST_CELLS // len(choice_keys))
+    results = []
+    for start in range(0, len(value_strs), chunk_size):
+        chunk = value_strs[start:start + chunk_size]
+        # ratio on token-sorted forms is token_sort_ratio without re-sorting the choices
+        scores = process.cdist(
+            [token_sort_key(value_str) for value_str in chunk], choice_keys,
+            scorer=fuzz.ratio,
+            processor=None,
+            score_cutoff=threshold - 0.5,
+            dtype=np.float32,
+            workers=workers,
+        )
+        # fuzzywuzzy rounded scores to integers; keep the same threshold edge
+        scores = np.rint(scores)
+
+        for row, value_str in enumerate(chunk):
+            hits = [word_positions[word] for word in value_str.split() if word in word_positions]
+            if hits:
+                scores[row, min(hits)] = 100
+
+        best = scores.argmax(axis=1)
+        best_scores = scores[np.arange(len(chunk)), best]
+        results.extend(
+            (int(position) if score >= threshold else None, int(score))
+            for position, score in zip(best, best_scores)
+        )
+    return results
+
+
+def best_match_positions(values, choices, threshold=70, workers=-1):
+    """Positions-only form of best_matches."""
+    return [position for position, _ in best_matches(values, choices, threshold, workers)]
+
+
+class NgramIndex:
+    """
+    Character n-gram blocking index over a DB column.
+
+    Built once per table; each lookup only scores the rows sharing the most
+    n-grams with the value and returns the row position directly. Lookups
+    count the value's rarest n-grams first and stop after
+    `max_scanned` posting entries, so grams common to most names (" sh",
+    "an ") do not make each lookup linear in the table size.
+    """
+
+    def __init__(self, choices, n=3, max_candidates=MAX_CANDIDATES, max_scanned=MAX_SCANNED_POSTINGS):
+        self.n = n
+        self.max_candidates = max_candidates
+        self.max_scanned = max_scanned
+        self.choices = [full_process(choice) for choice in choices]
+        self.postings = defaultdict(list)
+        for position, choice in enumerate(self.choices):
+            for gram in set(self.ngrams(choice)):
+                self.postings[gram].append(position)
+
+    def ngrams(self, text):
+        padded = f" {text} "
+        return [padded[i:i + self.n] for i in range(max(len(padded) - self.n + 1, 1))]
+
+    def candidates(self, processed_value):
+        postings = sorted((self.postings[gram] for gram in set(self.ngrams(processed_value))
+                           if gram in self.postings), key=len)
+        counts = Counter()
+        budget = self.max_scanned
+        for positions in postings:
+            if len(positions) > budget:
+                if not counts:
+                    # Every gram is common; a bounded slice still yields candidates
+                    counts.update(positions[:budget])
+                break
+            counts.update(positions)
+            budget -= len(positions)
+        return sorted(position for position, _ in counts.most_common(self.max_candidates))
+
+    def extract_one(self, value):
+        """Return (position, score) of the best WRatio match, or None if no row shares an n-gram."""
+        processed_value = full_process(value)
+        candidates = {position: self.choices[position] for position in self.candidates(processed_value)}
+        if not candidates:
+            return None
+        _, score, position = process.extractOne(processed_value, candidates, scorer=fuzz.WRatio, processor=None)
+        # fuzzywuzzy reported integer scores; keep thresholds comparable
+        return position, round(score)
@@ -0,0 +1,86 @@
+import hashlib
+import os
+import sqlite3
+
+# Local store of earlier match results, shared by the pages and batch.py
+MEMO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "match_memo.sqlite3")
+
+# Keys per SELECT ... IN (...) lookup, well under SQLite's variable limit
+LOOKUP_BATCH_SIZE = 500
+
+
+def connect():
+    conn = sqlite3.connect(MEMO_PATH, timeout=30)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS match_memo (
+            matcher TEXT,
+            table_name TEXT,
+            column_name TEXT,
+            fingerprint TEXT,
+            value TEXT,
+            position INTEGER,
+            score REAL,
+            PRIMARY KEY (matcher, table_name, column_name, fingerprint, value)
+        )
+    """)
+    return conn
+
+
+def column_fingerprint(choices):
+    """Hash the column's values in order; any edit, insert or reorder changes it."""
+    digest = hashlib.sha256()
+    for choice in choices:
+        digest.update(str(choice).encode())
+        digest.update(b"\x1f")
+    return digest.hexdigest()
+
+
+def lookup(conn, matcher, table_name, column_name, fingerprint, keys):
+    found = {}
+    for start in range(0, len(keys), LOOKUP_BATCH_SIZE):
+        batch = keys[start:start + LOOKUP_BATCH_SIZE]
+        placeholders = ", ".join(["?"] * len(batch))
+        rows = conn.execute(
+            f"SELECT value, position, score FROM match_memo "
+            f"WHERE matcher = ? AND table_name = ? AND column_name = ? AND fingerprint = ? "
+            f"AND value IN ({placeholders})",
+            [matcher, table_name, column_name, fingerprint, *batch])
+        found.update({value: (position, score) for value, position, score in rows})
+    return found
+
+
+def store(conn, matcher, table_name, column_name, fingerprint, matches):
+    with conn:
+        # Results for an older version of the column can never be hit again
+        conn.execute(
+            "DELETE FROM match_memo WHERE matcher = ? AND table_name = ? AND column_name = ? "
+            "AND fingerprint != ?",
+            (matcher, table_name, column_name, fingerprint))
+        conn.executemany(
+            "INSERT OR REPLACE INTO match_memo VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(matcher, table_name, column_name, fingerprint, value, position, score)
+             for value, (position, score) in matches.items()])
+
+
+def memoized_matches(matcher, table_name, column_name, choices, keys, compute, fingerprint=None):
+    """
+    Return a (position, score) pair for every key, scoring only unseen ones.
+
+    `keys` are normalized input strings and `compute(missing_keys)` returns
+    their (position, score) pairs against `choices`. Results are remembered
+    per matcher, table, column and column fingerprint, which callers holding
+    column_fingerprint(choices) already can pass in.
+    """
+    fingerprint = fingerprint or column_fingerprint(choices)
+    unique_keys = list(dict.fromkeys(keys))
+    conn = connect()
+    try:
+        found = lookup(conn, matcher, table_name, column_name, fingerprint, unique_keys)
+        missing = [key for key in unique_keys if key not in found]
+        if missing:
+            computed = dict(zip(missing, compute(missing)))
+            store(conn, matcher, table_name, column_name, fingerprint, computed)
+            found.update(computed)
+    finally:
+        conn.close()
+    return [found[key] for key in keys]
@@ -1,26 +1,23 @@
 import os
 import streamlit as st
 import pandas as pd
-import mysql.connector
 from datetime import datetime
+from db import cache_metadata, clear_metadata_cache, ensure_unique_key, get_connection, insert_rows
+from ingest import read_sheet
+from tracing import span
 
-# Load database credentials from secrets.toml
-DB_HOST = st.secrets["database"]["DATABASE_HOST"]
-DB_USER = st.secrets["database"]["DATABASE_USER"]
-DB_PASSWORD = st.secrets["database"]["DATABASE_PASSWORD"]
-DB_NAME = st.secrets["database"]["DATABASE_NAME"]
-DB_PORT = int(st.secrets["database"]["DATABASE_PORT"])
+# Accepted 'Date of Enrollment' formats, in order of preference
+DATE_FORMATS = [
+    "%b %d %Y %I:%M%p", "%Y-%m-%d", "%m-%d-%Y", "%d-%m-%Y",
+    "%Y/%m/%d", "%d/%m/%Y", "%d-%b-%Y", "%m/%d/%Y",
+    "%Y-%m-%d %H:%M:%S", "%m-%d-%Y %H:%M:%S"
+]
 
+# Values used to pick a column's date format
+DATE_SAMPLE_SIZE = 200
 
-def get_connection():
-    """Establish a connection to the MySQL database."""
-    return mysql.connector.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        database=DB_NAME
-    )
 
+@cache_metadata
 def fetch_departments():
     """Fetch all departments from the Department table."""
     conn = get_connection()
@@ -34,27 +31,41 @@ def parse_date(date_str):
     """Parse date into a standard format."""
     if pd.isnull(date_str):
         return None
-    formats = [
-        "%b %d %Y %I:%M%p", "%Y-%m-%d", "%m-%d-%Y", "%d-%m-%Y",
-        "%Y/%m/%d", "%d/%m/%Y", "%d-%b-%Y", "%m/%d/%Y",
-        "%Y-%m-%d %H:%M:%S", "%m-%d-%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S"
-    ]
-    for fmt in formats:
+    for fmt in DATE_FORMATS:
         try:
             return datetime.strptime(date_str, fmt).strftime('%m/%d/%Y')
         except ValueError:
             continue
     return None
 
+def normalize_dates(dates):
+    """Convert a column to mm/dd/yyyy using one format detected from a sample."""
+    result = pd.Series([None] * len(dates), index=dates.index, dtype=object)
+    dates = dates.where(dates.notna())
+    sample = dates.dropna().head(DATE_SAMPLE_SIZE)
+    if sample.empty:
+        return result
+
+    # The first format that parses the most sampled values wins
+    best_format = max(DATE_FORMATS, key=lambda fmt: pd.to_datetime(
+        sample, format=fmt, errors="coerce").notna().sum())
+    parsed = pd.to_datetime(dates, format=best_format, errors="coerce")
+    result[parsed.notna()] = parsed[parsed.notna()].dt.strftime('%m/%d/%Y')
+
+    # Only values in some other format go through the per-row parser
+    residual = dates.notna() & parsed.isna()
+    result[residual] = dates[residual].map(parse_date)
+    return result.where(result.notna(), None)
+
 def check_existing_records(table_name, names):
     """Check for existing records in the database by Name."""
-    conn = get_connection()
-    cursor = conn.cursor()
-
     cleaned_names = [name for name in names if pd.notna(name)]
     if not cleaned_names:
         return set()
 
+    conn = get_connection()
+    cursor = conn.cursor()
+
     placeholders = ', '.join(['%s'] * len(cleaned_names))
     query = f"SELECT `Name` FROM {table_name} WHERE `Name` IN ({placeholders})"
     cursor.execute(query, cleaned_names)
@@ -62,6 +73,79 @@ def check_existing_records(table_name, names):
     conn.close()
     return set(record[0] for record in existing_records)
 
+def prepare_records(df, selected_columns, add_year_of_enrollment=False, with_department=False):
+    """Select, rename and clean the uploaded columns into the table layout."""
+    if add_year_of_enrollment:
+        df["Year of Enrollment"] = "2023-24"
+
+    column_order = list(selected_columns)
+    if add_year_of_enrollment:
+        column_order.insert(1, "Year of Enrollment")
+
+    final_df = df[column_order].copy()
+    renamed_columns = ["Name", "Year of Enrollment", "Student's Enrollment Number", "Date of Enrollment", "Eligibility"]
+    final_df.columns = renamed_columns[:len(final_df.columns)]
+
+    if "Date of Enrollment" in final_df.columns:
+        final_df["Date of Enrollment"] = normalize_dates(final_df["Date of Enrollment"])
+
+    # Clean 'Student's Enrollment Number'
+    if "Student's Enrollment Number" in final_df.columns:
+        final_df["Student's Enrollment Number"] = final_df["Student's Enrollment Number"].str.replace(
+            r'\.0$', '', regex=True
+        )
+
+    final_df["Eligibility"] = "eligible"
+    if with_department:
+        final_df["Department"] = df["Department"]
+    return final_df
+
+def resolve_table_name(dept_name, class_name, departments):
+    """Determine table name based on department and class."""
+    if dept_name == "All" and class_name == "FE":
+        return "all_fe_2023_24"
+    if dept_name == "All" and class_name == "DSE":
+        return "all_dse"
+    dept_info = next((dept for dept in departments if dept[2] == dept_name), None)
+    if dept_info:
+        dept_no, dept_code = dept_info[:2]
+        return f"{dept_no}_{dept_code}_{class_name}"
+    return f"{class_name}"
+
+def save_records(final_df, table_name, with_department=False):
+    """Create the table if needed and insert rows whose Name is new; returns the number inserted."""
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    # Create table if not exists
+    create_table_query = f"""
+    CREATE TABLE IF NOT EXISTS {table_name} (
+        Name VARCHAR(255),
+        `Year of Enrollment` VARCHAR(255),
+        `Student's Enrollment Number` VARCHAR(255),
+        `Date of Enrollment` VARCHAR(255),
+        Eligibility VARCHAR(255)
+    """
+    if with_department:
+        create_table_query += ", Department VARCHAR(255)"
+    create_table_query += ", UNIQUE KEY (Name))"
+
+    cursor.execute(create_table_query)
+    clear_metadata_cache()
+
+    # Insert data, letting the unique key on Name skip duplicates
+    if ensure_unique_key(cursor, table_name, "Name"):
+        inserted = insert_rows(cursor, table_name, final_df, ignore_duplicates=True)
+    else:
+        # Older tables may hold duplicate names or other unique keys; filter in Python instead
+        existing_names = check_existing_records(table_name, final_df["Name"].tolist())
+        new_rows = final_df[~final_df["Name"].isin(existing_names) & ~final_df["Name"].duplicated()]
+        inserted = insert_rows(cursor, table_name, new_rows)
+
+    conn.commit()
+    conn.close()
+    return inserted
+
 def main():
     st.title("PRN Generator")
 
@@ -79,7 +163,8 @@ def main():
     uploaded_file = st.file_uploader("Upload Excel File", type=["xlsx"])
 
     if uploaded_file:
-        df = pd.read_excel(uploaded_file)
+        # Read every cell as text so enrollment numbers never pass through float
+        df = read_sheet(uploaded_file, "pg1", dtype=str)
 
         selected_columns = st.multiselect("Select Columns", df.columns)
 
@@ -87,84 +172,15 @@ def main():
         if class_name == "FE" or dept_name == "All":
             add_year_of_enrollment = st.checkbox("Add Year of Enrollment Column")
 
-        if add_year_of_enrollment:
-            df["Year of Enrollment"] = "2023-24"
-
-        column_order = selected_columns[:]
-        if add_year_of_enrollment:
-            column_order.insert(1, "Year of Enrollment")
-
-        final_df = df[column_order]
-        renamed_columns = ["Name", "Year of Enrollment", "Student's Enrollment Number", "Date of Enrollment", "Eligibility"]
-        final_df.columns = renamed_columns[:len(final_df.columns)]
-
-        if "Date of Enrollment" in final_df.columns:
-            final_df["Date of Enrollment"] = final_df["Date of Enrollment"].apply(lambda x: parse_date(str(x)))
-
-        final_df["Eligibility"] = "eligible"
-        if dept_name == "All" and class_name == "DSE":
-            final_df["Department"] = df["Department"]
+        with_department = dept_name == "All" and class_name == "DSE"
 
         if st.button("Save to Database"):
-            conn = get_connection()
-            cursor = conn.cursor()
-
-            # Determine table name based on department and class
-            if dept_name == "All" and class_name == "FE":
-                table_name = "all_fe_2023_24"
-            elif dept_name == "All" and class_name == "DSE":
-                table_name = "all_dse"
-            else:
-                dept_info = next((dept for dept in departments if dept[2] == dept_name), None)
-                if dept_info:
-                    dept_no, dept_code = dept_info[:2]
-                    table_name = f"{dept_no}_{dept_code}_{class_name}"
-                else:
-                    table_name = f"{class_name}"
-
-            # Create table if not exists
-            create_table_query = f"""
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                Name VARCHAR(255),
-                `Year of Enrollment` VARCHAR(255),
-                `Student's Enrollment Number` VARCHAR(255),
-                `Date of Enrollment` VARCHAR(255),
-                Eligibility VARCHAR(255)
-            """
-            if dept_name == "All" and class_name == "DSE":
-                create_table_query += ", Department VARCHAR(255)"
-            create_table_query += ")"
-
-            cursor.execute(create_table_query)
-
-            # Clean 'Student's Enrollment Number'
-            final_df["Student's Enrollment Number"] = final_df["Student's Enrollment Number"].apply(
-                lambda x: str(x).replace('.0', '') if pd.notna(x) else None
-            )
-
-            # Check for existing records
-            names = final_df["Name"].tolist()
-            existing_names = check_existing_records(table_name, names)
-
-            # Insert data, avoiding duplicates
-            for _, row in final_df.iterrows():
-                row_values = [None if pd.isna(val) else val for val in row]
-
-                if row["Name"] not in existing_names:
-                    insert_query = f"""
-                    INSERT INTO {table_name} (Name, `Year of Enrollment`, `Student's Enrollment Number`, `Date of Enrollment`, Eligibility
-                    """
-                    if dept_name == "All" and class_name == "DSE":
-                        insert_query += ", Department"
-                    insert_query += ") VALUES (%s, %s, %s, %s, %s"
-                    if dept_name == "All" and class_name == "DSE":
-                        insert_query += ", %s"
-                    insert_query += ")"
-                    cursor.execute(insert_query, row_values)
-                    existing_names.add(row["Name"])  # Update existing names set
-
-            conn.commit()
-            conn.close()
+            # Prepared only on save, so widget changes do not redo or trace it
+            with span("pg1", "prepare", rows=len(df)):
+                final_df = prepare_records(df, selected_columns, add_year_of_enrollment, with_department)
+            table_name = resolve_table_name(dept_name, class_name, departments)
+            with span("pg1", "write", table=table_name, rows=len(final_df)) as record:
+                record["inserted"] = save_records(final_df, table_name, with_department)
             st.success(f"Data saved to {table_name} table in the University database.")
 
 if __name__ == "__main__":
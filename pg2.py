@@ -1,25 +1,24 @@
 import os
 import streamlit as st
 import pandas as pd
-from sqlalchemy import create_engine
-from io import BytesIO
-import base64
+import io
+import xlsxwriter
+import snapshots
+from db import DB_NAME, cache_metadata, get_engine
+from tracing import span
 
-# Load database credentials from secrets.toml
-DB_HOST = st.secrets["database"]["DATABASE_HOST"]
-DB_USER = st.secrets["database"]["DATABASE_USER"]
-DB_PASSWORD = st.secrets["database"]["DATABASE_PASSWORD"]
-DB_NAME = st.secrets["database"]["DATABASE_NAME"]
-DB_PORT = int(st.secrets["database"]["DATABASE_PORT"])
+# Shared pooled SQLAlchemy engine
+engine = get_engine()
 
-# Create SQLAlchemy engine
-connection_string = f"mysql+mysqlconnector://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-engine = create_engine(connection_string)
+# Sheet order for class tables
+CLASS_ORDER = {'fe': 1, 'se': 2, 'te': 3, 'be': 4}
 
+@cache_metadata
 def fetch_departments():
     query = "SELECT Dept_name, Dept_Code, Dept_no FROM Department"
     return pd.read_sql(query, engine)
 
+@cache_metadata
 def fetch_tables(Dept_no, Dept_Code):
     query = f"""
     SELECT table_name
@@ -35,50 +34,92 @@ def fetch_tables(Dept_no, Dept_Code):
     tables_list = tables_df['table_name'].tolist()  # Change here
 
     # Sort tables in the order fe, se, te, be
-    sorted_tables = sorted(tables_list, key=lambda x: int(x.split(
-        '_')[-1].replace('fe', '1').replace('se', '2').replace('te', '3').replace('be', '4')))
+    sorted_tables = sorted(tables_list, key=lambda x: CLASS_ORDER.get(
+        x.split('_')[-1].lower(), len(CLASS_ORDER) + 1))
 
     return sorted_tables
 
-def create_and_download_excel(sheets_dict, file_name):
-    excel_file_bytes = BytesIO()
-    with pd.ExcelWriter(excel_file_bytes, engine='xlsxwriter') as writer:
-        for sheet_name, df in sheets_dict.items():
-            df = df.fillna('') 
-            df.to_excel(writer, index=False, sheet_name=sheet_name)
-            workbook = writer.book
-            worksheet = writer.sheets[sheet_name]
-            header_format = workbook.add_format(
-                {'bold': True, 'font_size': 12, 'font_name': 'Times New Roman', 'text_wrap': True, 'valign': 'vcenter'})
-            cell_format = workbook.add_format(
-                {'font_size': 12, 'font_name': 'Times New Roman', 'text_wrap': True, 'valign': 'vcenter'})
-            red_fill = workbook.add_format({'bg_color': '#FF0000'})
-
-            for col_num, value in enumerate(df.columns.values):
-                worksheet.write(0, col_num, value, header_format)
-            for row_num in range(1, len(df) + 1):
-                for col_num, value in enumerate(df.iloc[row_num - 1]):
-                    if df.columns[col_num] == "Student's Enrollment Number":
-                        worksheet.write_string(
-                            row_num, col_num, str(value), cell_format)
-                    else:
-                        worksheet.write(row_num, col_num, value, cell_format)
-                    if pd.isna(value) and df.columns[col_num] == "Student's Enrollment Number":
-                        worksheet.write_blank(row_num, col_num, None, red_fill)
-            worksheet.set_default_row(30)
-
-            for i in range(4):
-                max_len = max(df.iloc[:, i].astype(
-                    str).apply(len).max(), len(df.columns[i]))
-                worksheet.set_column(i, i, max_len + 2)
-
-            if len(df.columns) > 4:
-                worksheet.set_column(4, len(df.columns) - 1,
-                                     None, None, {'hidden': True})
-
-    href = f'<a href="data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{base64.b64encode(excel_file_bytes.getvalue()).decode()}" download="{file_name}.xlsx">Download {file_name}.xlsx</a>'
-    st.markdown(href, unsafe_allow_html=True)
+def write_rows(worksheet, df, first_row, cell_format, red_fill):
+    """Write one DataFrame chunk starting at first_row; returns the widths of its first four columns."""
+    # Convert each column once up front instead of building a Series per row
+    df = df.fillna('')
+    enrollment_col = None
+    blank_enrollment = [False] * len(df)
+    if "Student's Enrollment Number" in df.columns:
+        enrollment_col = df.columns.get_loc("Student's Enrollment Number")
+        enrollment = df["Student's Enrollment Number"].astype(str)
+        blank_enrollment = (enrollment == '').tolist()
+        df = df.assign(**{"Student's Enrollment Number": enrollment})
+
+    rows = zip(*(df.iloc[:, i].astype(object).tolist() for i in range(len(df.columns))))
+    for row_num, (values, is_blank) in enumerate(zip(rows, blank_enrollment), start=first_row):
+        worksheet.write_row(row_num, 0, values, cell_format)
+        if is_blank:
+            worksheet.write_blank(row_num, enrollment_col, None, red_fill)
+
+    return [df.iloc[:, i].astype(str).str.len().max() if len(df) else 0
+            for i in range(min(4, len(df.columns)))]
+
+def build_excel(sheets_dict):
+    """Write each sheet from a DataFrame or an iterable of DataFrame chunks; returns the .xlsx bytes."""
+    # constant_memory flushes each row to a temp file as soon as the next row starts
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    header_format = workbook.add_format(
+        {'bold': True, 'font_size': 12, 'font_name': 'Times New Roman', 'text_wrap': True, 'valign': 'vcenter'})
+    cell_format = workbook.add_format(
+        {'font_size': 12, 'font_name': 'Times New Roman', 'text_wrap': True, 'valign': 'vcenter'})
+    red_fill = workbook.add_format({'bg_color': '#FF0000'})
+
+    for sheet_name, chunks in sheets_dict.items():
+        if isinstance(chunks, pd.DataFrame):
+            chunks = [chunks]
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.set_default_row(30)
+
+        columns = None
+        widths = []
+        next_row = 1
+        for df in chunks:
+            if columns is None:
+                columns = df.columns
+                widths = [len(str(column)) for column in columns[:4]]
+                worksheet.write_row(0, 0, columns.tolist(), header_format)
+            chunk_widths = write_rows(worksheet, df, next_row, cell_format, red_fill)
+            widths = [max(width, chunk_width) for width, chunk_width in zip(widths, chunk_widths)]
+            next_row += len(df)
+
+        # Column settings are stored until close(), so they can follow the rows
+        for i, max_len in enumerate(widths):
+            worksheet.set_column(i, i, max_len + 2)
+
+        if columns is not None and len(columns) > 4:
+            worksheet.set_column(4, len(columns) - 1,
+                                 None, None, {'hidden': True})
+
+    workbook.close()
+    return output.getvalue()
+
+def create_and_download_excel(make_sheets, file_name):
+    """
+    Offer a report whose workbook is built only when its download button is clicked.
+
+    make_sheets() returns {sheet name: DataFrame or iterable of DataFrame chunks}.
+    Until the click, neither the rows nor the workbook are held in the session.
+    """
+    def build():
+        with span("pg2", "Excel build", report=file_name):
+            return build_excel(make_sheets())
+
+    st.download_button(
+        f"Download {file_name}.xlsx",
+        build,
+        file_name=f"{file_name}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        on_click="ignore",
+    )
 
+@cache_metadata
 def fetch_year_institute_wise_tables(class_name):
     query = f"""
     SELECT table_name 
@@ -90,12 +131,26 @@ def fetch_year_institute_wise_tables(class_name):
     tables_list = tables_df['table_name'].tolist()
     return tables_list
     
+@cache_metadata
 def fetch_all_tables():
     query = f"SHOW TABLES FROM {DB_NAME}"
     tables_df = pd.read_sql(query, engine)
     tables_list = tables_df.iloc[:, 0].tolist()
     return tables_list
 
+def non_empty_tables(tables):
+    """Bring the snapshots of `tables` up to date and keep those holding rows."""
+    with span("pg2", "DB fetch", tables=len(tables)) as record:
+        record["refreshed"] = snapshots.sync(tables)
+    return [table for table in tables if snapshots.row_count(table)]
+
+def export_snapshots(tables, sheet_name, file_name, source_column='Source Table'):
+    """Offer a single-sheet report streamed from table snapshots; skipped when they hold no rows."""
+    tables = non_empty_tables(tables)
+    if tables:
+        create_and_download_excel(
+            lambda: {sheet_name: snapshots.iter_combined(tables, source_column)}, file_name)
+
 def main():
     st.title("Report Generator")
 
@@ -116,26 +171,18 @@ def main():
             tables = fetch_tables(Dept_no, Dept_Code)
 
             if export_type == 'Institute wise':
-                if st.button("Export"):
-                    combined_data = []
-                    for table in tables:
-                        df = pd.read_sql(f"SELECT * FROM {table}", engine)
-                        if not df.empty:
-                            combined_data.append(df)
-                    if combined_data:
-                        combined_df = pd.concat(combined_data, ignore_index=True)
-                        create_and_download_excel({'Combined Data': combined_df}, f"{Dept_no}_{Dept_Code}_Institute_Wise")
+                if st.button("Export") and tables:
+                    export_snapshots(tables, 'Combined Data', f"{Dept_no}_{Dept_Code}_Institute_Wise")
 
             elif export_type == 'Department wise':
                 if st.button("Export"):
-                    sheets_dict = {}
-                    for table in tables:
-                        class_name = table.split('_')[-1]
-                        df = pd.read_sql(f"SELECT * FROM {table}", engine)
-                        if not df.empty:
-                            sheets_dict[class_name] = df
-                    if sheets_dict:
-                        create_and_download_excel(sheets_dict, f"{Dept_no}_{Dept_Code}_Department_Wise")
+                    # One sheet per class table, read from its snapshot when the download is clicked
+                    sheet_tables = {table.split('_')[-1]: table for table in non_empty_tables(tables)}
+                    if sheet_tables:
+                        create_and_download_excel(
+                            lambda: {class_name: snapshots.read_snapshot(table)
+                                     for class_name, table in sheet_tables.items()},
+                            f"{Dept_no}_{Dept_Code}_Department_Wise")
 
     elif export_type == 'Year Institute Wise':
         class_name = st.selectbox("Select CLASS", ['FE', 'SE', 'TE', 'BE'])
@@ -143,51 +190,36 @@ def main():
             tables = fetch_year_institute_wise_tables(class_name)
             if st.button("Export"):
                 if tables:
-                    combined_data = []
-                    for table in tables:
-                        df = pd.read_sql(f"SELECT * FROM {table}", engine)
-                        if not df.empty:
-                            combined_data.append(df)
-                    if combined_data:
-                        combined_df = pd.concat(combined_data, ignore_index=True)
-                        create_and_download_excel({'Combined Data': combined_df}, f"{class_name}_Year_Institute_Wise")
+                    export_snapshots(tables, 'Combined Data', f"{class_name}_Year_Institute_Wise")
                 else:
                     st.warning("No tables found for the selected class.")
 
     elif export_type == 'Year Department Wise':
         class_name = st.selectbox("Select CLASS", ['FE', 'SE', 'TE', 'BE'])
-        if class_name:
-            dept_names = ['auto', 'comps', 'ecs', 'extc', 'it', 'mech']  # Define department names
-            sheets_dict = {}
-            for dept_name in dept_names:
-                table_name = f"{dept_name}_{class_name.lower()}"
-                tables = fetch_year_institute_wise_tables(class_name)
-
-                st.write(f"Tables found for {table_name}: {tables}")  # Debug output
-                
-                if tables:
-                    combined_data = []
-                    for table in tables:
-                        df = pd.read_sql(f"SELECT * FROM {table}", engine)
-                        if not df.empty:
-                            combined_data.append(df)
-                    if combined_data:
-                        combined_df = pd.concat(combined_data, ignore_index=True)
-                        sheets_dict[dept_name] = combined_df
-
-            if st.button("Export"):
-                if sheets_dict:
-                    create_and_download_excel(sheets_dict, f"{class_name}_Year_Department_Wise")
-                else:
-                    st.warning("No data found for the selected class and departments.")
+        if class_name and st.button("Export"):
+            tables = non_empty_tables(fetch_year_institute_wise_tables(class_name))
+            # Tables are named {Dept_no}_{Dept_Code}_{class}; one sheet per code found
+            sheet_tables = {}
+            for table in tables:
+                parts = table.split('_')
+                if len(parts) >= 3:  # LIKE also matches names such as 'cafe'
+                    sheet_tables.setdefault(parts[-2].lower(), []).append(table)
+            sheet_tables = dict(sorted(sheet_tables.items()))
+
+            if sheet_tables:
+                # Every sheet gets the columns of all the class's tables, as one combined read did
+                create_and_download_excel(
+                    lambda: {dept_name: snapshots.iter_combined(dept_table_list, 'Source Table', columns_from=tables)
+                             for dept_name, dept_table_list in sheet_tables.items()},
+                    f"{class_name}_Year_Department_Wise")
+            else:
+                st.warning("No data found for the selected class.")
 
     elif export_type == 'Individual':
         tables = fetch_all_tables()
         selected_table = st.selectbox("Select Table", tables)
         if selected_table and st.button("Export"):
-            df = pd.read_sql(f"SELECT * FROM {selected_table}", engine)
-            if not df.empty:
-                create_and_download_excel({'Sheet1': df}, selected_table)
+            export_snapshots([selected_table], 'Sheet1', selected_table, source_column=None)
 
 if __name__ == "__main__":
     main()
@@ -3,30 +3,19 @@ import streamlit as st
 import pandas as pd
 import mysql.connector
 from fuzzywuzzy import process
+from db import cache_metadata, get_connection
+from candidates import candidate_index
+from ingest import read_sheet, sheet_names
+from memo import memoized_matches
+from rapidfuzz import utils
+from tracing import span
 
-# Function to connect to MySQL database
-# Load database credentials from secrets.toml
-DB_HOST = st.secrets["database"]["DATABASE_HOST"]
-DB_USER = st.secrets["database"]["DATABASE_USER"]
-DB_PASSWORD = st.secrets["database"]["DATABASE_PASSWORD"]
-DB_NAME = st.secrets["database"]["DATABASE_NAME"]
-DB_PORT = int(st.secrets["database"]["DATABASE_PORT"])
-
-
-
+# Function to borrow a connection from the shared pool
 
 
 def connect_to_database():
-    # Replace with your actual database credentials
-    db_config = {
-        'user': DB_USER,  # Change this to your MySQL username
-        'password': DB_PASSWORD,  # Change this to your MySQL password
-        'host': DB_HOST,
-        'database': DB_NAME
-    }
     try:
-        connection = mysql.connector.connect(**db_config)
-        return connection
+        return get_connection()
     except mysql.connector.Error as err:
         st.error(f"Error: {err}")
         return None
@@ -34,23 +23,183 @@ def connect_to_database():
 # Function to list all tables in the database
 
 
-def list_tables(connection):
-    query = "SHOW TABLES"
-    cursor = connection.cursor()
-    cursor.execute(query)
-    tables = cursor.fetchall()
+@cache_metadata
+def list_tables():
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SHOW TABLES")
+        tables = cursor.fetchall()
+    finally:
+        connection.close()
     return [table[0] for table in tables]
 
 # Function to list all columns in a given table
 
 
-def list_columns(connection, table_name):
-    query = f"SHOW COLUMNS FROM {table_name}"
-    cursor = connection.cursor()
-    cursor.execute(query)
-    columns = cursor.fetchall()
+@cache_metadata
+def list_columns(table_name):
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"SHOW COLUMNS FROM {table_name}")
+        columns = cursor.fetchall()
+    finally:
+        connection.close()
     return [column[0] for column in columns]
 
+# Function to write eligibility values through a staging table in one transaction
+
+
+def update_eligibility(connection, table_name, column_name, eligibility_by_value):
+    rows = [(value, eligibility) for value, eligibility in eligibility_by_value.items()
+            if value is not None]
+    cursor = connection.cursor()
+    try:
+        # Copy the key column's type and collation so the join compares like with like
+        cursor.execute("DROP TEMPORARY TABLE IF EXISTS eligibility_staging")
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE eligibility_staging "
+            f"SELECT `{column_name}` AS value, eligibility FROM {table_name} LIMIT 0")
+        cursor.executemany(
+            "INSERT INTO eligibility_staging (value, eligibility) VALUES (%s, %s)", rows)
+        cursor.execute(
+            f"UPDATE {table_name} t JOIN eligibility_staging s ON t.`{column_name}` = s.value "
+            f"SET t.eligibility = s.eligibility")
+        cursor.execute("DROP TEMPORARY TABLE eligibility_staging")
+        connection.commit()
+    except mysql.connector.Error:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+# Function to keep only the values whose stored eligibility differs from the new one;
+# returns {value: (current eligibilities, new eligibility)}
+
+
+def eligibility_changes(table_df, keys, eligibility_by_value):
+    eligibility_column = next(
+        (column for column in table_df.columns if column.lower() == 'eligibility'), None)
+    current_by_value = {}
+    if eligibility_column is not None:
+        for key, current in zip(keys, table_df[eligibility_column]):
+            current_by_value.setdefault(key, set()).add(current)
+    # A value shared by several rows changes if any of them holds something else
+    return {value: (current_by_value.get(value, set()), eligibility)
+            for value, eligibility in eligibility_by_value.items()
+            if current_by_value.get(value) != {eligibility}}
+
+# Function to mark matched dropout students as not eligible
+
+
+def mark_dropouts(connection, table_name, db_column, excel_values):
+    # Blank cells are not students; str(NaN) would otherwise fuzzy-match names containing "nan"
+    excel_values = excel_values.dropna()
+    excel_values = excel_values[excel_values.astype(str).str.strip() != '']
+    with span("pg3", "DB fetch", table=table_name) as record:
+        index = candidate_index(table_name, db_column, connection)
+        table_df = index.table_df
+        record["rows"] = len(table_df)
+    matched_records = []
+    updated_records = []
+    unmatched_records = []
+
+    # Reuse remembered matches; names equal up to titles, case and word order need no scoring
+    def score_missing(missing):
+        results = []
+        for key in missing:
+            position = index.find(key)
+            if position is not None:
+                results.append((position, 100))
+            else:
+                results.append(index.ngram_index.extract_one(key) or (None, 0))
+        return results
+
+    with span("pg3", "match", table=table_name, rows=len(table_df), values=len(excel_values)):
+        keys = [utils.default_process(str(excel_value)) for excel_value in excel_values]
+        results = memoized_matches("pg3.dropout.normalized", table_name, db_column,
+                                   index.values, keys, score_missing, index.fingerprint)
+    for excel_value, result in zip(excel_values, results):
+        if result[0] is not None and result[1] > 60:  # Adjust the threshold as needed
+            position = result[0]
+            best_match = table_df[db_column].iloc[position]
+            matched_record = table_df.iloc[[position]]
+            matched_records.append(
+                (excel_value, best_match))
+            updated_records.append(matched_record)
+        else:
+            unmatched_records.append(excel_value)
+
+    # Update the 'eligibility' column in the matched records
+    with span("pg3", "write", table=table_name, rows=len(updated_records)):
+        update_eligibility(connection, table_name, db_column, {
+            record[db_column].values[0]: 'not eligible'
+            for record in updated_records})
+    return matched_records, updated_records, unmatched_records
+
+# Function to mark students on the HOD list eligible and everyone else not eligible
+
+
+def apply_hod_list(connection, table_name, db_column, excel_values):
+    with span("pg3", "DB fetch", table=table_name) as record:
+        table_df = candidate_index(table_name, db_column, connection).table_df
+        record["rows"] = len(table_df)
+    matched_records = []
+    unmatched_records = []
+
+    with span("pg3", "match", table=table_name, rows=len(table_df), values=len(excel_values)):
+        # Prepare the set of Excel column values for fuzzy matching
+        excel_values_set = set(
+            excel_values.astype(str))
+
+        # Iterate through database records and compare with Excel values
+        for index, row in table_df.iterrows():
+            # Ensure db_value is a string
+            db_value = str(row[db_column])
+            result = process.extractOne(
+                db_value, excel_values_set)
+
+            # Check if result is valid string
+            if result and isinstance(result[0], str):
+                best_match, score = result  # Since we're only interested in best_match and score
+                if score > 70:
+                    matched_records.append(
+                        (db_value, best_match))
+                else:
+                    unmatched_records.append(db_value)
+            else:
+                unmatched_records.append(db_value)
+
+    # Update the 'eligibility' column for matched and unmatched records
+    eligibility_by_value = {
+        db_value: 'eligible' for db_value, _ in matched_records}
+    eligibility_by_value.update(
+        {db_value: 'not eligible' for db_value in unmatched_records})
+
+    # Write back only the rows whose eligibility actually changes
+    changes = eligibility_changes(
+        table_df, table_df[db_column].astype(str), eligibility_by_value)
+    if changes:
+        with span("pg3", "write", table=table_name, rows=len(changes)):
+            update_eligibility(connection, table_name, db_column, {
+                value: eligibility for value, (_, eligibility) in changes.items()})
+    return matched_records, unmatched_records, changes
+
+# Function to summarize an eligibility change set on the page
+
+
+def show_eligibility_changes(db_column, changes, total):
+    now_eligible = sum(1 for _, eligibility in changes.values() if eligibility == 'eligible')
+    st.write(f"Eligibility changes: {now_eligible} now eligible, "
+             f"{len(changes) - now_eligible} now not eligible, {total - len(changes)} unchanged")
+    if changes:
+        st.dataframe(pd.DataFrame(
+            [(value, ", ".join(sorted(map(str, current))), eligibility)
+             for value, (current, eligibility) in changes.items()],
+            columns=[db_column, "Previous eligibility", "New eligibility"]), hide_index=True)
+
 
 def main():
     # Streamlit UI
@@ -68,12 +217,10 @@ def main():
         # Step 1: Upload Excel file
         uploaded_file = st.file_uploader("Upload an Excel file", type=['xlsx'])
         if uploaded_file:
-            workbook = pd.ExcelFile(uploaded_file)
-            sheet_names = workbook.sheet_names
-            selected_sheet = st.selectbox("Select a sheet", sheet_names)
+            selected_sheet = st.selectbox("Select a sheet", sheet_names(uploaded_file))
 
             if selected_sheet:
-                sheet_df = pd.read_excel(workbook, sheet_name=selected_sheet)
+                sheet_df = read_sheet(uploaded_file, "pg3", selected_sheet)
                 excel_columns = sheet_df.columns.tolist()
                 selected_excel_column = st.selectbox(
                     "Select a column from the Excel sheet", excel_columns)
@@ -81,48 +228,27 @@ def main():
                 # Display column data for reference
                 st.write(sheet_df[selected_excel_column])
 
-                # Step 2: Connect to the database and list tables
-                connection = connect_to_database()
-                if connection:
-                    tables = list_tables(connection)
-                    selected_table = st.selectbox(
-                        "Select a table from the database", tables)
-
-                    if selected_table:
-                        table_columns = list_columns(
-                            connection, selected_table)
-                        selected_db_column = st.selectbox(
-                            "Select a column from the database table", table_columns)
-
-                        # Step 3: Perform fuzzy matching and update the database
-                        if st.button("Run Comparison and Update Database"):
-                            table_df = pd.read_sql(
-                                f"SELECT * FROM {selected_table}", connection)
-                            matched_records = []
-                            updated_records = []
-                            unmatched_records = []
-
-                            for excel_value in sheet_df[selected_excel_column]:
-                                result = process.extractOne(
-                                    excel_value, table_df[selected_db_column])
-                                if result:
-                                    best_match, score, _ = result  # Handle the returned index as well
-                                    if score > 60:  # Adjust the threshold as needed
-                                        matched_record = table_df[table_df[selected_db_column]
-                                                                  == best_match]
-                                        matched_records.append(
-                                            (excel_value, best_match))
-                                        updated_records.append(matched_record)
-                                    else:
-                                        unmatched_records.append(excel_value)
-
-                            # Update the 'eligibility' column in the matched records
-                            for record in updated_records:
-                                name_to_update = record[selected_db_column].values[0]
-                                query = f"UPDATE {selected_table} SET eligibility = 'not eligible' WHERE {selected_db_column} = '{name_to_update}'"
-                                cursor = connection.cursor()
-                                cursor.execute(query)
-                                connection.commit()
+                # Step 2: List tables
+                tables = list_tables()
+                selected_table = st.selectbox(
+                    "Select a table from the database", tables)
+
+                if selected_table:
+                    table_columns = list_columns(selected_table)
+                    selected_db_column = st.selectbox(
+                        "Select a column from the database table", table_columns)
+
+                    # Step 3: Perform fuzzy matching and update the database
+                    if st.button("Run Comparison and Update Database"):
+                        # Borrowed only for the update, so reruns before the click hold no connection
+                        connection = connect_to_database()
+                        if connection:
+                            try:
+                                matched_records, updated_records, unmatched_records = mark_dropouts(
+                                    connection, selected_table, selected_db_column,
+                                    sheet_df[selected_excel_column])
+                            finally:
+                                connection.close()
 
                             # Display results
                             st.write("Matched Records:", matched_records)
@@ -130,11 +256,9 @@ def main():
                             st.write("Unmatched Records:", unmatched_records)
 
                             st.write("Columns updated:", [selected_db_column])
-                            cursor.close()
-                            connection.close()
-                else:
-                    st.error(
-                        "Failed to connect to the database. Please check your credentials and try again.")
+                        else:
+                            st.error(
+                                "Failed to connect to the database. Please check your credentials and try again.")
 
     elif option == 'HOD list':
         st.subheader("HOD List")
@@ -142,80 +266,45 @@ def main():
         # Step 1: Upload Excel file
         uploaded_file = st.file_uploader("Upload an Excel file", type=['xlsx'])
         if uploaded_file:
-            workbook = pd.ExcelFile(uploaded_file)
-            sheet_names = workbook.sheet_names
-            selected_sheet = st.selectbox("Select a sheet", sheet_names)
+            selected_sheet = st.selectbox("Select a sheet", sheet_names(uploaded_file))
 
             if selected_sheet:
-                sheet_df = pd.read_excel(workbook, sheet_name=selected_sheet)
+                sheet_df = read_sheet(uploaded_file, "pg3", selected_sheet)
                 excel_column = st.selectbox(
                     "Select a column from the Excel sheet", sheet_df.columns.tolist())
 
                 # Display column data for reference
                 st.write(sheet_df[excel_column])
 
-                # Step 2: Connect to the database and list tables
-                connection = connect_to_database()
-                if connection:
-                    tables = list_tables(connection)
-                    selected_table = st.selectbox(
-                        "Select a table from the database", tables)
-
-                    if selected_table:
-                        table_columns = list_columns(
-                            connection, selected_table)
-                        db_column = st.selectbox(
-                            "Select a column from the database table", table_columns)
-
-                        # Step 3: Perform fuzzy matching and update the database
-                        if st.button("Run Comparison and Update Database"):
-                            table_df = pd.read_sql(
-                                f"SELECT * FROM {selected_table}", connection)
-                            matched_records = []
-                            unmatched_records = []
-
-                            # Prepare the set of Excel column values for fuzzy matching
-                            excel_values_set = set(
-                                sheet_df[excel_column].astype(str))
-
-                            # Iterate through database records and compare with Excel values
-                            for index, row in table_df.iterrows():
-                                # Ensure db_value is a string
-                                db_value = str(row[db_column])
-                                result = process.extractOne(
-                                    db_value, excel_values_set)
-
-                                # Check if result is valid string
-                                if result and isinstance(result[0], str):
-                                    best_match, score = result  # Since we're only interested in best_match and score
-                                    if score > 70:
-                                        matched_records.append(
-                                            (db_value, best_match))
-                                        query = f"UPDATE {selected_table} SET eligibility = 'eligible' WHERE {db_column} = '{db_value}'"
-                                        cursor = connection.cursor()
-                                        cursor.execute(query)
-                                        connection.commit()
-                                    else:
-                                        unmatched_records.append(db_value)
-                                else:
-                                    unmatched_records.append(db_value)
-
-                            # Update the 'eligibility' column in the unmatched records
-                            for db_value in unmatched_records:
-                                query = f"UPDATE {selected_table} SET eligibility = 'not eligible' WHERE {db_column} = '{db_value}'"
-                                cursor = connection.cursor()
-                                cursor.execute(query)
-                                connection.commit()
+                # Step 2: List tables
+                tables = list_tables()
+                selected_table = st.selectbox(
+                    "Select a table from the database", tables)
+
+                if selected_table:
+                    table_columns = list_columns(selected_table)
+                    db_column = st.selectbox(
+                        "Select a column from the database table", table_columns)
+
+                    # Step 3: Perform fuzzy matching and update the database
+                    if st.button("Run Comparison and Update Database"):
+                        # Borrowed only for the update, so reruns before the click hold no connection
+                        connection = connect_to_database()
+                        if connection:
+                            try:
+                                matched_records, unmatched_records, changes = apply_hod_list(
+                                    connection, selected_table, db_column, sheet_df[excel_column])
+                            finally:
+                                connection.close()
 
                             # Display results
+                            show_eligibility_changes(db_column, changes, len(
+                                {db_value for db_value, _ in matched_records} | set(unmatched_records)))
                             st.write("Matched Records:", matched_records)
                             st.write("Unmatched Records:", unmatched_records)
-
-                            cursor.close()
-                            connection.close()
-                else:
-                    st.error(
-                        "Failed to connect to the database. Please check your credentials and try again.")
+                        else:
+                            st.error(
+                                "Failed to connect to the database. Please check your credentials and try again.")
 
 
 if __name__ == "__main__":
@@ -1,68 +1,55 @@
 import streamlit as st
-import pandas as pd
 import mysql.connector
-from fuzzywuzzy import fuzz, process
-
-# Load database credentials from secrets.toml
-
-DB_HOST = st.secrets["database"]["DATABASE_HOST"]
-DB_USER = st.secrets["database"]["DATABASE_USER"]
-DB_PASSWORD = st.secrets["database"]["DATABASE_PASSWORD"]
-DB_NAME = st.secrets["database"]["DATABASE_NAME"]
-
-
-def get_db_connection():
-    return mysql.connector.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        database=DB_NAME
-    )
+from db import (INSERT_BATCH_SIZE, cache_metadata, clear_metadata_cache, ensure_unique_key, get_connection,
+                insert_rows, read_query)
+from candidates import candidate_index
+from ingest import read_sheet
+from matching import best_matches
+from memo import memoized_matches
+from tracing import span
 
 # Function to fetch table names from the database
-def get_table_names(conn):
-    cursor = conn.cursor()
+@cache_metadata
+def get_table_names(_conn):
+    cursor = _conn.cursor()
     cursor.execute("SHOW TABLES")
     tables = cursor.fetchall()
     return [table[0] for table in tables]
 
 # Function to fetch column names from a table
-def get_column_names(conn, table_name):
-    cursor = conn.cursor()
+@cache_metadata
+def get_column_names(_conn, table_name):
+    cursor = _conn.cursor()
     cursor.execute(f"SHOW COLUMNS FROM {table_name}")
     columns = cursor.fetchall()
     return [column[0] for column in columns]
 
 # Function to fetch data from a table
 def get_table_data(conn, table_name):
-    return pd.read_sql(f"SELECT * FROM `{table_name}`", conn)
-
-# Function to perform fuzzy matching and find the closest match
-def fuzzy_match(value, choices):
-    best_match = None
-    highest_ratio = -1
-
-    value_str = str(value).lower()  # Ensure value is a string
-
-    for choice in choices:
-        choice_str = str(choice).lower()  # Ensure choice is a string
-        ratio = fuzz.token_sort_ratio(value_str, choice_str)
-        if ratio > highest_ratio:
-            highest_ratio = ratio
-            best_match = choice
-
-        # Check for partial matches or substring matches
-        for part in value_str.split():
-            if part in choice_str:
-                ratio = 100  # You can adjust this threshold as needed
-                if ratio > highest_ratio:
-                    highest_ratio = ratio
-                    best_match = choice
-
-    return best_match if highest_ratio >= 70 else None
+    return read_query(f"SELECT * FROM `{table_name}`", connection=conn)
+
+# Function to collect the matched rows of db_data for every Excel value;
+# `index` is db_data's CandidateIndex for db_column when the caller has one
+def match_records(excel_values, db_data, db_column, table_name=None, index=None):
+    choices = db_data[db_column].tolist() if index is None else index.values
+    forms = None if index is None else index.forms
+    if table_name is None:
+        positions = [position for position, _ in best_matches(excel_values, choices, forms=forms)]
+    else:
+        # Collapsing whitespace does not change token_sort_ratio or the word-substring check
+        keys = [" ".join(str(value).lower().split()) for value in excel_values]
+        matches = memoized_matches("pg4.fuzzy_match", table_name, db_column, choices, keys,
+                                   lambda missing: best_matches(missing, choices, forms=forms),
+                                   fingerprint=None if index is None else index.fingerprint)
+        positions = [position for position, _ in matches]
+    matched_positions = [position for position in positions if position is not None]
+    unmatched = [value for value, position in zip(excel_values, positions) if position is None]
+    return db_data.iloc[matched_positions], unmatched
 
 def check_existing_records(table_name, column_name, values):
-    conn = get_db_connection()
+    if not values:
+        return set()
+    conn = get_connection()
     cursor = conn.cursor()
     placeholders = ', '.join(['%s'] * len(values))
     query = f"SELECT `{column_name}` FROM {table_name} WHERE `{column_name}` IN ({placeholders})"
@@ -71,47 +58,40 @@ def check_existing_records(table_name, column_name, values):
     conn.close()
     return set([record[0] for record in existing_records])
 
-def append_data_to_table(table_name, data):
-    conn = get_db_connection()
+# Function to create a table like the source table; returns False if it already exists
+def create_table_like(conn, new_table_name, source_table):
+    cursor = conn.cursor()
+    cursor.execute(f"SHOW TABLES LIKE '{new_table_name}'")
+    if cursor.fetchone():
+        return False
+    # IF NOT EXISTS so a concurrent creator (e.g. another batch worker) is not an error
+    create_table_query = f"CREATE TABLE IF NOT EXISTS `{new_table_name}` LIKE `{source_table}`"
+    cursor.execute(create_table_query)
+    conn.commit()
+    clear_metadata_cache()
+    return True
+
+# Function to insert matched rows that are not already in the target table in one transaction;
+# returns the number inserted, or rolls everything back and raises on failure
+def insert_matched_records(conn, new_table_name, matched_df, db_column, batch_size=INSERT_BATCH_SIZE):
     cursor = conn.cursor()
     try:
-        # Select only the required columns from the DataFrame
-        data = data[['Name', 'Year of Enrollment', "Student's Enrollment Number", 'Eligibility', 'Date of Enrollment']]
-
-        # Format 'Date of Enrollment' column to 'mm/dd/yyyy' format
-        def format_date(date_str):
-            parts = date_str.split('-')
-            if len(parts) == 3:
-                return f"{parts[1]}/{parts[2]}/{parts[0]}"
-            else:
-                return date_str
-
-        data['Date of Enrollment'] = data['Date of Enrollment'].apply(format_date)
-
-        # Check for existing records to avoid duplicates
-        existing_records = check_existing_records(table_name, "Student's Enrollment Number", data["Student's Enrollment Number"].tolist())
-        data_to_append = data[~data["Student's Enrollment Number"].isin(existing_records)]
-
-        if not data_to_append.empty:
-            # Construct the SQL query for insertion
-            columns = ', '.join(['`' + col + '`' for col in data_to_append.columns])
-            placeholders = ', '.join(['%s'] * len(data_to_append.columns))
-            sql = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
-
-            # Convert DataFrame to list of tuples
-            data_values = [tuple(row) for row in data_to_append.values]
-
-            # Execute the query
-            cursor.executemany(sql, data_values)
-            conn.commit()
-            st.write(f"Data appended to {table_name}")
+        # Adding the key commits implicitly, so it happens before any row is written
+        if ensure_unique_key(cursor, new_table_name, db_column):
+            # The unique key rejects duplicates server-side
+            inserted = insert_rows(cursor, new_table_name, matched_df, ignore_duplicates=True,
+                                   batch_size=batch_size)
         else:
-            st.write(f"No new data to append to {table_name}")
-    except Exception as e:
-        st.write(f"Error appending data to {table_name}: {e}")
+            existing_records = check_existing_records(new_table_name, db_column, matched_df[db_column].tolist())
+            inserted = insert_rows(cursor, new_table_name, matched_df[~matched_df[db_column].isin(existing_records)],
+                                   batch_size=batch_size)
+        conn.commit()
+    except mysql.connector.Error:
+        conn.rollback()
+        raise
     finally:
-        conn.close()
-
+        cursor.close()
+    return inserted
 
 def main():
     # Streamlit app
@@ -124,7 +104,7 @@ def main():
         # Step 1: Upload Excel file
         uploaded_file = st.file_uploader("Upload Excel file", type=["xlsx"])
         if uploaded_file:
-            df_excel = pd.read_excel(uploaded_file)
+            df_excel = read_sheet(uploaded_file, "pg4")
             st.write("Uploaded Excel file preview:")
             st.write(df_excel.head())
 
@@ -134,98 +114,88 @@ def main():
                 "Select a column from Excel file", excel_columns, key="excel_column_selectbox")
 
             # Step 3: Connect to MySQL and list tables
-            conn = get_db_connection()
-            if conn.is_connected():
-                tables = get_table_names(conn)
-                selected_table = st.selectbox(
-                    "Select a table from the database", tables, key="db_table_selectbox")
-
-                if selected_table:
-                    # Step 4: List columns from selected table
-                    db_columns = get_column_names(conn, selected_table)
-                    selected_db_column = st.selectbox(
-                        "Select a column from the database table", db_columns, key="db_column_selectbox")
-
-                    if selected_db_column:
-                        # Step 5: Fetch data from the selected table
-                        db_data = get_table_data(conn, selected_table)
-
-                        # Step 6: Select department and create new table name
-                        department_table_data = get_table_data(conn, "Department")
-                        st.write("Department table columns:", department_table_data.columns)
-
-                        if "Dept_name" in department_table_data.columns:
-                            departments = department_table_data["Dept_name"].tolist()
-                            selected_department = st.selectbox(
-                                "Select a department", departments, key="department_selectbox")
-
-                            # Find the corresponding Dept_no and Dept_Code
-                            dept_info = department_table_data[department_table_data["Dept_name"] == selected_department].iloc[0]
-                            dept_no = dept_info["Dept_no"]
-                            Dept_Code = dept_info["Dept_code"]
-                            new_table_name = f"{dept_no}_{Dept_Code}_FE"
-
-                            if st.button("Run Comparison"):
-                                # Step 7: Perform comparison and create a new table with matched records
-                                matches = []
-                                unmatched = []
-                                for excel_value in df_excel[selected_excel_column].dropna():
-                                    match = fuzzy_match(excel_value, db_data[selected_db_column].tolist())
-                                    if match:
-                                        matched_record = db_data[db_data[selected_db_column] == match].iloc[0]
-                                        matches.append(matched_record)
+            conn = get_connection()
+            try:
+                if conn.is_connected():
+                    tables = get_table_names(conn)
+                    selected_table = st.selectbox(
+                        "Select a table from the database", tables, key="db_table_selectbox")
+
+                    if selected_table:
+                        # Step 4: List columns from selected table
+                        db_columns = get_column_names(conn, selected_table)
+                        selected_db_column = st.selectbox(
+                            "Select a column from the database table", db_columns, key="db_column_selectbox")
+
+                        if selected_db_column:
+                            # Step 5: Select department and create new table name
+                            department_table_data = get_table_data(conn, "Department")
+                            st.write("Department table columns:", department_table_data.columns)
+
+                            if "Dept_name" in department_table_data.columns:
+                                departments = department_table_data["Dept_name"].tolist()
+                                selected_department = st.selectbox(
+                                    "Select a department", departments, key="department_selectbox")
+
+                                # Find the corresponding Dept_no and Dept_Code
+                                dept_info = department_table_data[department_table_data["Dept_name"] == selected_department].iloc[0]
+                                dept_no = dept_info["Dept_no"]
+                                Dept_Code = dept_info["Dept_code"]
+                                new_table_name = f"{dept_no}_{Dept_Code}_FE"
+
+                                if st.button("Run Comparison"):
+                                    # Step 6: Fetch data from the selected table, reused until the table changes
+                                    with span("pg4", "DB fetch", table=selected_table) as record:
+                                        index = candidate_index(selected_table, selected_db_column, conn)
+                                        db_data = index.table_df
+                                        record["rows"] = len(db_data)
+
+                                    # Step 7: Perform comparison and create a new table with matched records
+                                    with span("pg4", "match", table=selected_table, rows=len(db_data)):
+                                        matched_df, unmatched = match_records(
+                                            df_excel[selected_excel_column].dropna().tolist(), db_data, selected_db_column,
+                                            selected_table, index)
+                                    if not matched_df.empty:
+                                        st.write("Matched records:")
+                                        st.write(matched_df)
+
+                                    if unmatched:
+                                        st.write("Unmatched records:")
+                                        st.write(unmatched)
+
+                                    # Step 8: Save matched records into the new table
+                                    if create_table_like(conn, new_table_name, selected_table):
+                                        st.success(f"Table '{new_table_name}' created successfully.")
+                                    else:
+                                        st.warning(f"Table '{new_table_name}' already exists. Skipping table creation.")
+
+                                    try:
+                                        with span("pg4", "write", table=new_table_name, rows=len(matched_df)) as record:
+                                            record["inserted"] = insert_matched_records(
+                                                conn, new_table_name, matched_df, selected_db_column)
+                                    except mysql.connector.Error as e:
+                                        st.error(f"Saving matched records failed and was rolled back: {e}")
                                     else:
-                                        unmatched.append(excel_value)
-
-                                matched_df = pd.DataFrame(matches)
-                                if not matched_df.empty:
-                                    st.write("Matched records:")
-                                    st.write(matched_df)
-
-                                if unmatched:
-                                    st.write("Unmatched records:")
-                                    st.write(unmatched)
-
-                                # Step 8: Save matched records into the new table
-                                cursor = conn.cursor()
-                                cursor.execute(f"SHOW TABLES LIKE '{new_table_name}'")
-                                if cursor.fetchone():
-                                    st.warning(f"Table '{new_table_name}' already exists. Skipping table creation.")
-                                else:
-                                    create_table_query = f"CREATE TABLE `{new_table_name}` LIKE `{selected_table}`"
-                                    cursor.execute(create_table_query)
-                                    conn.commit()
-                                    st.success(f"Table '{new_table_name}' created successfully.")
-
-                                existing_records = check_existing_records(new_table_name, selected_db_column, matched_df[selected_db_column].tolist())
-
-                                for _, row in matched_df.iterrows():
-                                    if row[selected_db_column] not in existing_records:
-                                        placeholders = ", ".join(["%s"] * len(row))
-                                        columns = ", ".join([f"`{col}`" for col in row.index])
-                                        insert_query = f"INSERT INTO `{new_table_name}` ({columns}) VALUES ({placeholders})"
-                                        cursor.execute(insert_query, tuple(row))
-                                        conn.commit()
-
-                                st.success(f"Matched records have been saved to the new table: {new_table_name}")
-
-                                # Preview the new table
-                                new_table_data = get_table_data(conn, new_table_name)
-                                st.write(f"Preview of the new table '{new_table_name}':")
-                                st.write(new_table_data)
-
-                        else:
-                            st.error("The 'Dept_name' column does not exist in the 'department' table.")
-
-                    conn.close()
-                else:
-                    st.error("Failed to connect to the database.")
+                                        st.success(f"{record['inserted']} matched records have been saved to the new table: {new_table_name}")
+
+                                    # Preview the new table
+                                    new_table_data = get_table_data(conn, new_table_name)
+                                    st.write(f"Preview of the new table '{new_table_name}':")
+                                    st.write(new_table_data)
+
+                            else:
+                                st.error("The 'Dept_name' column does not exist in the 'department' table.")
+                    else:
+                        st.error("Failed to connect to the database.")
+            finally:
+                # Hand the connection back to the pool on every rerun, even after an error
+                conn.close()
 
     elif selected_department == "FE - All Branchwise":
         # Step 1: Upload Excel file
         uploaded_file = st.file_uploader("Upload Excel file", type=["xlsx"])
         if uploaded_file:
-            df_excel = pd.read_excel(uploaded_file)
+            df_excel = read_sheet(uploaded_file, "pg4")
             st.write("Uploaded Excel file preview:")
             st.write(df_excel.head())
 
@@ -234,73 +204,64 @@ def main():
             selected_excel_column = st.selectbox("Select a column from Excel file", excel_columns, key="excel_column_selectbox")
 
             # Step 3: Connect to MySQL and list tables
-            conn = get_db_connection()
-            if conn.is_connected():
-                tables = get_table_names(conn)
-                selected_table = st.selectbox("Select a table from the database", tables, key="db_table_selectbox")
-
-                if selected_table:
-                    # Step 4: List columns from selected table
-                    db_columns = get_column_names(conn, selected_table)
-                    selected_db_column = st.selectbox("Select a column from the database table", db_columns, key="db_column_selectbox")
-
-                    if selected_db_column:
-                        # Step 5: Fetch data from the selected table
-                        db_data = get_table_data(conn, selected_table)
-
-                        # Step 6: Perform comparison and create a new table with matched records
-                        matches = []
-                        unmatched = []
-                        for excel_value in df_excel[selected_excel_column].dropna():
-                            match = fuzzy_match(excel_value, db_data[selected_db_column].tolist())
-                            if match:
-                                matched_record = db_data[db_data[selected_db_column] == match].iloc[0]
-                                matches.append(matched_record)
+            conn = get_connection()
+            try:
+                if conn.is_connected():
+                    tables = get_table_names(conn)
+                    selected_table = st.selectbox("Select a table from the database", tables, key="db_table_selectbox")
+
+                    if selected_table:
+                        # Step 4: List columns from selected table
+                        db_columns = get_column_names(conn, selected_table)
+                        selected_db_column = st.selectbox("Select a column from the database table", db_columns, key="db_column_selectbox")
+
+                        if selected_db_column:
+                            # Step 5: Fetch data from the selected table
+                            # Reused across reruns until the table changes
+                            with span("pg4", "DB fetch", table=selected_table) as record:
+                                index = candidate_index(selected_table, selected_db_column, conn)
+                                db_data = index.table_df
+                                record["rows"] = len(db_data)
+
+                            # Step 6: Perform comparison and create a new table with matched records
+                            with span("pg4", "match", table=selected_table, rows=len(db_data)):
+                                matched_df, unmatched = match_records(
+                                    df_excel[selected_excel_column].dropna().tolist(), db_data, selected_db_column,
+                                    selected_table, index)
+                            if not matched_df.empty:
+                                st.write("Matched records:")
+                                st.write(matched_df)
+
+                            if unmatched:
+                                st.write("Unmatched records:")
+                                st.write(unmatched)
+
+                            # Save matched records into a new table
+                            new_table_name = f"Branchwise_FE_{selected_excel_column}"
+
+                            if create_table_like(conn, new_table_name, selected_table):
+                                st.success(f"Table '{new_table_name}' created successfully.")
+                            else:
+                                st.warning(f"Table '{new_table_name}' already exists. Skipping table creation.")
+
+                            try:
+                                with span("pg4", "write", table=new_table_name, rows=len(matched_df)) as record:
+                                    record["inserted"] = insert_matched_records(
+                                        conn, new_table_name, matched_df, selected_db_column)
+                            except mysql.connector.Error as e:
+                                st.error(f"Saving matched records failed and was rolled back: {e}")
                             else:
-                                unmatched.append(excel_value)
-
-                        matched_df = pd.DataFrame(matches)
-                        if not matched_df.empty:
-                            st.write("Matched records:")
-                            st.write(matched_df)
-
-                        if unmatched:
-                            st.write("Unmatched records:")
-                            st.write(unmatched)
-
-                        # Save matched records into a new table
-                        new_table_name = f"Branchwise_FE_{selected_excel_column}"
-
-                        cursor = conn.cursor()
-                        cursor.execute(f"SHOW TABLES LIKE '{new_table_name}'")
-                        if cursor.fetchone():
-                            st.warning(f"Table '{new_table_name}' already exists. Skipping table creation.")
-                        else:
-                            create_table_query = f"CREATE TABLE `{new_table_name}` LIKE `{selected_table}`"
-                            cursor.execute(create_table_query)
-                            conn.commit()
-                            st.success(f"Table '{new_table_name}' created successfully.")
-
-                        existing_records = check_existing_records(new_table_name, selected_db_column, matched_df[selected_db_column].tolist())
-
-                        for _, row in matched_df.iterrows():
-                            if row[selected_db_column] not in existing_records:
-                                placeholders = ", ".join(["%s"] * len(row))
-                                columns = ", ".join([f"`{col}`" for col in row.index])
-                                insert_query = f"INSERT INTO `{new_table_name}` ({columns}) VALUES ({placeholders})"
-                                cursor.execute(insert_query, tuple(row))
-                                conn.commit()
-
-                        st.success(f"Matched records have been saved to the new table: {new_table_name}")
-
-                        # Preview the new table
-                        new_table_data = get_table_data(conn, new_table_name)
-                        st.write(f"Preview of the new table '{new_table_name}':")
-                        st.write(new_table_data)
-
-                    conn.close()
-                else:
-                    st.error("Failed to connect to the database.")
+                                st.success(f"{record['inserted']} matched records have been saved to the new table: {new_table_name}")
+
+                            # Preview the new table
+                            new_table_data = get_table_data(conn, new_table_name)
+                            st.write(f"Preview of the new table '{new_table_name}':")
+                            st.write(new_table_data)
+                    else:
+                        st.error("Failed to connect to the database.")
+            finally:
+                # Hand the connection back to the pool on every rerun, even after an error
+                conn.close()
 
     else:
         st.warning("Please select a valid department.")
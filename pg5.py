@@ -1,54 +1,28 @@
 import os
 import streamlit as st
-import mysql.connector
 import pandas as pd
-
-# MySQL connection setup
-
-# Load database credentials from secrets.toml
-DB_HOST = st.secrets["database"]["DATABASE_HOST"]
-DB_USER = st.secrets["database"]["DATABASE_USER"]
-DB_PASSWORD = st.secrets["database"]["DATABASE_PASSWORD"]
-DB_NAME = st.secrets["database"]["DATABASE_NAME"]
-DB_PORT = int(st.secrets["database"]["DATABASE_PORT"])
-
-
-
-
-def get_db_connection():
-    return mysql.connector.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        database=DB_NAME
-    )
+from concurrent.futures import ThreadPoolExecutor
+from db import POOL_SIZE, cache_metadata, ensure_unique_key, get_connection, insert_rows, stream_query
+from tracing import span
 
 # Fetch column names of a specific table
 
 
+@cache_metadata
 def fetch_columns(table_name):
-    conn = get_db_connection()
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(f"DESCRIBE {table_name}")
     columns = cursor.fetchall()
     conn.close()
     return [column[0] for column in columns]
 
-# Fetch data from a specific table
-
-
-def fetch_table_data(table_name):
-    conn = get_db_connection()
-    query = f"SELECT * FROM {table_name}"
-    df = pd.read_sql(query, conn)
-    conn.close()
-    return df
-
 # Fetch list of all tables in the database
 
 
+@cache_metadata
 def fetch_all_tables():
-    conn = get_db_connection()
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SHOW TABLES")
     tables = cursor.fetchall()
@@ -58,36 +32,49 @@ def fetch_all_tables():
 # Fetch department numbers from the Department table
 
 
+@cache_metadata
 def fetch_dept_numbers():
-    conn = get_db_connection()
+    conn = get_connection()
     query = "SELECT Dept_Code, Dept_no FROM Department"
     df = pd.read_sql(query, conn)
     conn.close()
     return df
 
-# Check if records already exist in the target table based on Student's Enrollment Number
+# Check if records already exist in the target table
 
 
-def check_existing_records(table_name, records):
-    conn = get_db_connection()
+def check_existing_records(table_name, column_name, values):
+    if not values:
+        return []
+    conn = get_connection()
     cursor = conn.cursor()
-    placeholders = ', '.join(['%s'] * len(records))
-    query = f"SELECT `Student's Enrollment Number` FROM {table_name} WHERE `Student's Enrollment Number` IN ({placeholders})"
-    cursor.execute(query, records)
+    placeholders = ', '.join(['%s'] * len(values))
+    query = f"SELECT `{column_name}` FROM {table_name} WHERE `{column_name}` IN ({placeholders})"
+    cursor.execute(query, values)
     existing_records = cursor.fetchall()
     conn.close()
     return [record[0] for record in existing_records]
 
-# Append data to a specific table
+# Check once per table whether its enrollment-number key can skip rows already in it
+
+
+def enrollment_key_usable(table_name):
+    conn = get_connection()
+    try:
+        return ensure_unique_key(conn.cursor(), table_name, "Student's Enrollment Number")
+    finally:
+        conn.close()
+
+# Append rows to a specific table on a pooled connection; returns the number of new rows
 
 
-def append_data_to_table(table_name, data):
-    conn = get_db_connection()
+def append_rows(table_name, data, use_key):
+    conn = get_connection()
     cursor = conn.cursor()
     try:
         # Select only the required columns from the DataFrame
         data = data[['Name', 'Year of Enrollment',
-                     "Student's Enrollment Number", 'Eligibility', 'Date of Enrollment']]
+                     "Student's Enrollment Number", 'Eligibility', 'Date of Enrollment']].copy()
 
         # Format 'Date of Enrollment' column to 'mm/dd/yyyy' format
         def format_date(date_str):
@@ -100,33 +87,84 @@ def append_data_to_table(table_name, data):
         data['Date of Enrollment'] = data['Date of Enrollment'].apply(
             format_date)
 
-        # Check for existing records to avoid duplicates
-        existing_records = check_existing_records(
-            table_name, data["Student's Enrollment Number"].tolist())
-        data_to_append = data[~data["Student's Enrollment Number"].isin(
-            existing_records)]
-
-        if not data_to_append.empty:
-            # Construct the SQL query for insertion
-            columns = ', '.join(
-                ['`' + col + '`' for col in data_to_append.columns])
-            placeholders = ', '.join(['%s'] * len(data_to_append.columns))
-            sql = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
-
-            # Convert DataFrame to list of tuples
-            data_values = [tuple(row) for row in data_to_append.values]
-
-            # Execute the query
-            cursor.executemany(sql, data_values)
-            conn.commit()
-            st.write(f"Data appended to {table_name}")
+        # Let a unique key on the enrollment number skip rows already in the table
+        if use_key:
+            inserted = insert_rows(cursor, table_name, data, ignore_duplicates=True)
         else:
-            st.write(f"No new data to append to {table_name}")
-    except Exception as e:
-        st.write(f"Error appending data to {table_name}: {e}")
+            existing_records = check_existing_records(
+                table_name, "Student's Enrollment Number", data["Student's Enrollment Number"].tolist())
+            inserted = insert_rows(cursor, table_name, data[~data["Student's Enrollment Number"].isin(
+                existing_records)])
+        conn.commit()
+        return inserted
     finally:
         conn.close()
 
+# Report the outcome of an append on the page
+
+
+def report_append(table_name, outcome):
+    if isinstance(outcome, Exception):
+        st.write(f"Error appending data to {table_name}: {outcome}")
+    elif outcome:
+        st.write(f"Data appended to {table_name}")
+    else:
+        st.write(f"No new data to append to {table_name}")
+
+# Map every department code to its SE table name in one pass over the Department table
+
+
+def dse_table_names(dept_numbers):
+    # The first row wins when a code is listed twice
+    dept_numbers = dept_numbers.drop_duplicates('Dept_Code')
+    table_names = (dept_numbers['Dept_no'].astype(str) + '_' +
+                   dept_numbers['Dept_Code'].astype(str) + '_SE').str.lower()
+    return dict(zip(dept_numbers['Dept_Code'], table_names))
+
+# Resolve the SE table for a department code, reporting why when there is none
+
+
+def resolve_dept_table(dept_value, table_names, all_tables):
+    dept_table_name = table_names.get(dept_value)
+    if dept_table_name is None:
+        st.write(
+            f"Department code {dept_value} not found in Department table.")
+        return None
+
+    # Debugging: Print the constructed table name
+    st.write(f"Constructed table name: {dept_table_name}")
+
+    if dept_table_name not in all_tables:
+        st.write(
+            f"Table {dept_table_name} does not exist in the database.")
+        return None
+    return dept_table_name
+
+# Append one chunk of all_dse to the department tables, each department on its own pooled connection;
+# outcomes collects the rows inserted per table, or the table's first error
+
+
+def distribute_chunk(executor, df, dept_tables, table_keys, outcomes):
+    futures = {}
+    # One groupby pass partitions the chunk instead of one filter per department
+    for dept_value, dept_rows in df.groupby('Department', sort=False):
+        table_name = dept_tables.get(dept_value)
+        if not table_name or isinstance(outcomes.get(table_name), Exception):
+            continue
+        if table_name not in table_keys:
+            try:
+                table_keys[table_name] = enrollment_key_usable(table_name)
+            except Exception as e:
+                outcomes[table_name] = e
+                continue
+        futures[table_name] = executor.submit(append_rows, table_name, dept_rows, table_keys[table_name])
+
+    for table_name, future in futures.items():
+        try:
+            outcomes[table_name] = outcomes.get(table_name, 0) + future.result()
+        except Exception as e:
+            outcomes[table_name] = e
+
 
 def main():
     # Streamlit UI
@@ -137,8 +175,6 @@ def main():
     if st.button('Load Data from all_dse'):
         columns = fetch_columns(selected_table)
         if 'Department' in columns:
-            df = fetch_table_data(selected_table)
-            department_values = df['Department'].unique()
             all_tables = fetch_all_tables()
 
             # Debugging: Print all the tables
@@ -150,26 +186,26 @@ def main():
             # Debugging: Print department numbers
             st.write("Department numbers:")
             st.write(dept_numbers)
-
-            for dept_value in department_values:
-                matching_dept = dept_numbers[dept_numbers['Dept_Code']
-                                             == dept_value]
-                if not matching_dept.empty:
-                    Dept_no = matching_dept['Dept_no'].values[0]
-                    dept_table_name = f"{Dept_no}_{dept_value}_SE".lower()
-
-                    # Debugging: Print the constructed table name
-                    st.write(f"Constructed table name: {dept_table_name}")
-
-                    if dept_table_name in all_tables:
-                        matching_data = df[df['Department'] == dept_value]
-                        append_data_to_table(dept_table_name, matching_data)
-                    else:
-                        st.write(
-                            f"Table {dept_table_name} does not exist in the database.")
-                else:
-                    st.write(
-                        f"Department code {dept_value} not found in Department table.")
+            table_names = dse_table_names(dept_numbers)
+
+            # Stream all_dse in chunks so memory stays flat however large it grows
+            dept_tables = {}
+            table_keys = {}
+            outcomes = {}
+            with span("pg5", "DB fetch + write", table=selected_table) as record, \
+                    ThreadPoolExecutor(max_workers=POOL_SIZE) as executor:
+                record["rows"] = 0
+                for df in stream_query(f"SELECT * FROM {selected_table}"):
+                    record["rows"] += len(df)
+                    for dept_value in df['Department'].dropna().unique():
+                        if dept_value not in dept_tables:
+                            dept_tables[dept_value] = resolve_dept_table(
+                                dept_value, table_names, all_tables)
+                    distribute_chunk(executor, df, dept_tables, table_keys, outcomes)
+
+            # Reported from the script thread once the stream is done; worker threads cannot write to the page
+            for table_name, outcome in outcomes.items():
+                report_append(table_name, outcome)
 
 
 if __name__ == "__main__":
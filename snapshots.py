@@ -0,0 +1,133 @@
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from db import POOL_SIZE, STREAM_CHUNK_ROWS, read_query, stream_query, table_signatures
+
+# Local Parquet copies of the tables reports are built from
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshots")
+
+# Schema metadata key holding the (row count, checksum) a snapshot was taken at
+SIGNATURE_KEY = b"prn_snapshot_signature"
+
+
+def snapshot_path(table):
+    return os.path.join(SNAPSHOT_DIR, f"{table}.parquet")
+
+
+def stored_signature(table):
+    try:
+        metadata = pq.read_schema(snapshot_path(table)).metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return None
+    value = metadata.get(SIGNATURE_KEY)
+    return json.loads(value) if value else None
+
+
+# Arrow types for MySQL columns that are all NULL in a table's first chunk; others become strings
+NULL_COLUMN_TYPES = {
+    "tinyint": pa.int64(), "smallint": pa.int64(), "mediumint": pa.int64(), "int": pa.int64(),
+    "bigint": pa.int64(), "float": pa.float64(), "double": pa.float64(), "decimal": pa.float64(),
+    "date": pa.date32(), "datetime": pa.timestamp("us"), "timestamp": pa.timestamp("us"),
+}
+
+
+def _snapshot_schema(table, schema, signature):
+    fields = list(schema)
+    if any(pa.types.is_null(field.type) for field in fields):
+        # No value to infer a type from yet, so take it from the column definitions
+        column_types = dict(read_query(
+            "SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.columns "
+            f"WHERE table_schema = DATABASE() AND table_name = '{table}'").values.tolist())
+        fields = [field.with_type(NULL_COLUMN_TYPES.get(str(column_types.get(field.name, "")).lower(), pa.string()))
+                  if pa.types.is_null(field.type) else field for field in fields]
+    return pa.schema(fields, metadata={SIGNATURE_KEY: json.dumps(signature)})
+
+
+def refresh(table, signature):
+    """Stream a table from MySQL into a new snapshot and replace the old one atomically."""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=SNAPSHOT_DIR, suffix=".tmp")
+    os.close(fd)
+    try:
+        writer = None
+        try:
+            # One chunk is held at a time; later chunks are cast to the first one's schema
+            for chunk in stream_query(f"SELECT * FROM `{table}`"):
+                arrow_chunk = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    schema = _snapshot_schema(table, arrow_chunk.schema, signature)
+                    writer = pq.ParquetWriter(temp_path, schema)
+                writer.write_table(arrow_chunk.cast(schema))
+        finally:
+            if writer is not None:
+                writer.close()
+        os.replace(temp_path, snapshot_path(table))
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def sync(tables):
+    """
+    Bring the snapshots of `tables` up to date; returns the tables re-read.
+
+    A snapshot is reused while its table's row count and CHECKSUM TABLE value
+    are unchanged. The signature is taken before the table is read, so a
+    write racing the refresh only causes another refresh next time.
+    """
+    if not tables:
+        return []
+    signatures = table_signatures(tables)
+    # A NULL checksum means the server could not compute one; never trust the snapshot then
+    stale = [table for table in tables
+             if signatures[table][1] is None or stored_signature(table) != signatures[table]]
+    if stale:
+        with ThreadPoolExecutor(max_workers=min(POOL_SIZE, len(stale))) as executor:
+            list(executor.map(lambda table: refresh(table, signatures[table]), stale))
+    return stale
+
+
+def _to_pandas(arrow_data):
+    # Keep nullable integer columns as ints rather than floats, as MySQL returned them
+    return arrow_data.to_pandas(integer_object_nulls=True)
+
+
+def read_snapshot(table):
+    """Read a whole snapshot through a memory map."""
+    return _to_pandas(pq.read_table(snapshot_path(table), memory_map=True))
+
+
+def iter_snapshot(table, chunksize=STREAM_CHUNK_ROWS):
+    """Yield a snapshot as DataFrames of at most `chunksize` rows."""
+    parquet_file = pq.ParquetFile(snapshot_path(table), memory_map=True)
+    for batch in parquet_file.iter_batches(batch_size=chunksize):
+        yield _to_pandas(batch)
+
+
+def row_count(table):
+    """Rows in a table's snapshot, read from the Parquet footer."""
+    return pq.ParquetFile(snapshot_path(table)).metadata.num_rows
+
+
+def iter_combined(tables, source_column=None, chunksize=STREAM_CHUNK_ROWS, columns_from=None):
+    """
+    Yield the snapshots of several tables one after another as DataFrame chunks.
+
+    Every chunk has the union of the columns of `columns_from` (default:
+    `tables`) in first-seen order, missing ones left empty, plus
+    `source_column` naming the table if given.
+    """
+    columns = list(dict.fromkeys(
+        column for table in (columns_from or tables) for column in pq.read_schema(snapshot_path(table)).names))
+    if source_column:
+        columns.append(source_column)
+    for table in tables:
+        for chunk in iter_snapshot(table, chunksize):
+            if source_column:
+                chunk[source_column] = table
+            yield chunk.reindex(columns=columns)
@@ -0,0 +1,121 @@
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Optional [tracing] section of secrets.toml
+_settings = st.secrets.get("tracing", {})
+
+# One JSON object per finished stage, appended to this file
+TRACE_LOG_PATH = _settings.get(
+    "LOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "trace_log.jsonl"))
+
+# Per-stage Python heap peaks via tracemalloc; slows pure-Python stages, so off by default
+TRACE_PYTHON_MEMORY = bool(_settings.get("PYTHON_MEMORY", False))
+
+# The log is moved to LOG_PATH + ".1" (replacing the previous one) once it reaches this size
+TRACE_LOG_MAX_BYTES = int(_settings.get("LOG_MAX_MB", 10)) * 2 ** 20
+
+# Stages kept for the sidebar panel of each session
+PANEL_SPANS = 50
+
+if TRACE_PYTHON_MEMORY and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+_log_lock = threading.Lock()
+_local = threading.local()
+
+
+def max_rss_mib():
+    """High-water mark of the process's resident memory, or None where unavailable."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(max_rss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10), 1)
+
+
+def _session_spans():
+    # No script context outside `streamlit run` (batch.py) or in deferred download callables
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    return st.session_state.setdefault("trace_spans", [])
+
+
+@contextmanager
+def span(page, stage, **fields):
+    """
+    Time one stage of a page and log it with its memory use.
+
+    Yields the record so the caller can add fields such as row counts. Every
+    record gets seconds and the process's max RSS; with PYTHON_MEMORY on it
+    also gets the stage's Python heap peak, including nested stages.
+
+    tracemalloc's peak is process-wide and reset_peak() resets it for every
+    thread, so when sessions run stages at the same time, peak_mib includes
+    their allocations and a reset by one can lower another's peak. Compare
+    peaks from runs with a single active session.
+    """
+    record = {"time": datetime.now().isoformat(timespec="seconds"), "page": page, "stage": stage, **fields}
+    stack = _local.__dict__.setdefault("stack", [])
+    tracing_memory = tracemalloc.is_tracing()
+    if tracing_memory:
+        # Fold the peak so far into the enclosing stage before resetting it for this one
+        if stack:
+            stack[-1]["peak"] = max(stack[-1]["peak"], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    frame = {"peak": 0}
+    stack.append(frame)
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = repr(e)
+        raise
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 4)
+        stack.pop()
+        if tracing_memory:
+            peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+            record["peak_mib"] = round(peak / 2 ** 20, 1)
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+        record["max_rss_mib"] = max_rss_mib()
+        write_record(record)
+
+
+def write_record(record):
+    line = json.dumps(record, default=str)
+    with _log_lock:
+        if os.path.isfile(TRACE_LOG_PATH) and os.path.getsize(TRACE_LOG_PATH) >= TRACE_LOG_MAX_BYTES:
+            os.replace(TRACE_LOG_PATH, TRACE_LOG_PATH + ".1")
+        with open(TRACE_LOG_PATH, "a") as f:
+            f.write(line + "\n")
+    spans = _session_spans()
+    if spans is not None:
+        spans.append(record)
+        del spans[:-PANEL_SPANS]
+
+
+def show_panel():
+    """Render this session's recent stages in the sidebar, newest first."""
+    spans = _session_spans() or []
+    with st.sidebar.expander("Stage timings", expanded=True):
+        if not spans:
+            st.write("No stages recorded yet.")
+            return
+        st.dataframe(list(reversed(spans)), hide_index=True)
+        if st.button("Clear timings"):
+            spans.clear()